@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""Compare sync iterations of the git backends on a synthetic config repo."""
+
+import os
+import tempfile
+import time
+from subprocess import run
+
+import click
+
+from chart_updater.dulwich_git import DulwichGit, Repo
+from chart_updater.git import Git
+from chart_updater.helm_repo import HelmRepo
+from chart_updater.updater import Updater
+
+MANIFEST = """apiVersion: helm.toolkit.fluxcd.io/v2beta1
+kind: HelmRelease
+metadata:
+  name: chart-{index}
+  annotations:
+    rossum.ai/chart-auto-update: "true"
+    rossum.ai/chart-version: glob:1.*
+spec:
+  chart:
+    spec:
+      chart: chart-{index}
+      version: 1.0.0
+  values:
+    replicas: 1
+"""
+
+
+class StaticHelmRepo(HelmRepo):
+    # Releases a new version of every chart whenever it is told to
+    def __init__(self):
+        super().__init__("")
+        self.version = "1.0.0"
+
+    def update(self, chart_names=None):
+        return None
+
+    def get_latest_chart_versions(self, chart_name, chart_version_pattern):
+        return self.version, None
+
+
+def create_origin(manifests: int) -> str:
+    origin = tempfile.mkdtemp()
+    run(["git", "init", "--bare", "-q", "-b", "master", origin], check=True)
+    work = tempfile.mkdtemp()
+    run(["git", "clone", "-q", origin, work], check=True, capture_output=True)
+    os.makedirs(os.path.join(work, "deploy"))
+    for index in range(manifests):
+        with open(os.path.join(work, "deploy", f"chart-{index}.yaml"), "w") as f:
+            f.write(MANIFEST.format(index=index))
+    run(["git", "-C", work, "add", "."], check=True)
+    run(
+        ["git", "-C", work, "-c", "user.name=bench", "-c", "user.email=bench@x"]
+        + ["commit", "-q", "-m", "Init"],
+        check=True,
+    )
+    run(["git", "-C", work, "push", "-q", "origin", "master"], check=True)
+    return origin
+
+
+def measure(name: str, git: Git, rounds: int, batch_commits: bool) -> None:
+    cwd = os.getcwd()
+    helm_repo = StaticHelmRepo()
+    updater = Updater(git, helm_repo, batch_commits=batch_commits)
+    start = time.perf_counter()
+    updater.update_loop(one_shot=True)
+    first = time.perf_counter() - start
+    start = time.perf_counter()
+    for release in range(1, rounds + 1):
+        helm_repo.version = f"1.0.{release}"
+        helm_repo._resolved = {}
+        updater.update_loop(one_shot=True)
+    elapsed = (time.perf_counter() - start) / rounds
+    git.close()
+    os.chdir(cwd)
+    click.echo(f"{name:<32} {first * 1000:10.1f} ms {elapsed * 1000:10.1f} ms")
+
+
+@click.command()
+@click.option("--manifests", default=50, show_default=True, help="Manifests in repo.")
+@click.option("--rounds", default=3, show_default=True, help="Releases per backend.")
+def main(manifests, rounds):
+    backends = [("subprocess", Git)]
+    if Repo is not None:
+        backends.append(("dulwich", DulwichGit))
+    click.echo(f"{'backend':<32} {'first sync':>13} {'release':>13}")
+    for batch_commits in (False, True):
+        for git_bare in (False, True):
+            for name, git_class in backends:
+                label = " ".join(
+                    [name]
+                    + (["bare"] if git_bare else [])
+                    + (["batched"] if batch_commits else [])
+                )
+                git = git_class(create_origin(manifests), git_bare=git_bare)
+                measure(label, git, rounds, batch_commits)
+
+
+if __name__ == "__main__":
+    main()
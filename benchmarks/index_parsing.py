@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Compare parsers of a large synthetic Helm repository index."""
+
+import io
+import json
+import time
+from datetime import datetime, timedelta
+
+import click
+import yaml
+
+from chart_updater.helm_repo import HelmRepo
+
+
+def synthetic_index(charts: int, versions: int) -> dict:
+    created = datetime(2020, 1, 1)
+    entries = {}
+    for chart in range(charts):
+        entries[f"chart-{chart}"] = [
+            {
+                "apiVersion": "v2",
+                "name": f"chart-{chart}",
+                "version": f"1.{version // 100}.{version % 100}",
+                "appVersion": f"v1.{version}",
+                "created": (created + timedelta(minutes=version)).isoformat() + "Z",
+                "description": "A synthetic chart used for benchmarking",
+                "digest": f"{chart:032x}{version:032x}",
+                "urls": [f"charts/chart-{chart}-1.{version}.tgz"],
+            }
+            for version in range(versions)
+        ]
+    return {"apiVersion": "v1", "entries": entries, "generated": created.isoformat()}
+
+
+def measure(name: str, parse, content: bytes, rounds: int) -> None:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        parse(content)
+    elapsed = (time.perf_counter() - start) / rounds
+    click.echo(f"{name:<24} {elapsed * 1000:10.1f} ms")
+
+
+@click.command()
+@click.option("--charts", default=100, show_default=True, help="Number of charts.")
+@click.option("--versions", default=200, show_default=True, help="Versions per chart.")
+@click.option("--rounds", default=3, show_default=True, help="Repetitions per parser.")
+def main(charts, versions, rounds):
+    index = synthetic_index(charts, versions)
+    yaml_content = yaml.safe_dump(index).encode()
+    json_content = json.dumps(index).encode()
+    click.echo(f"YAML index: {len(yaml_content) / 2**20:.1f} MiB")
+    click.echo(f"JSON index: {len(json_content) / 2**20:.1f} MiB")
+
+    measure(
+        "yaml.SafeLoader",
+        lambda c: yaml.load(c, Loader=yaml.SafeLoader),
+        yaml_content,
+        rounds,
+    )
+    if hasattr(yaml, "CSafeLoader"):
+        measure(
+            "yaml.CSafeLoader",
+            lambda c: yaml.load(c, Loader=yaml.CSafeLoader),
+            yaml_content,
+            rounds,
+        )
+    measure("json", json.loads, json_content, rounds)
+    helm_repo = HelmRepo("")
+    measure(
+        "HelmRepo (YAML)",
+        lambda c: helm_repo._parse_index(io.BytesIO(c)),
+        yaml_content,
+        rounds,
+    )
+    measure(
+        "HelmRepo (JSON)",
+        lambda c: helm_repo._parse_index(io.BytesIO(c)),
+        json_content,
+        rounds,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -5,21 +5,26 @@ import os
 import threading
 
 import click
-from flask import Flask
+from flask import Flask, request
 from waitress import serve
 
+from chart_updater import UpdateException
+from chart_updater.dulwich_git import DulwichGit
 from chart_updater.git import Git
-from chart_updater.helm_repo import HelmRepo
+from chart_updater.helm_repo import ChartMuseumRepo, HelmRepo
 from chart_updater.updater import Updater
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
 log = logging.getLogger("chart-updater")
 app = Flask(__name__)
 event = threading.Event()
+rescan_event = threading.Event()
 
 
 @app.route("/api/v1/sync-git", methods=["POST"])
 def refresh():
+    if request.args.get("rescan", "").lower() == "true":
+        rescan_event.set()
     event.set()
     log.info("Sync-git triggered")
     return "Sync-git triggered."
@@ -55,13 +60,109 @@ def healthz():
     help="Git operations timeout (seconds).",
 )
 @click.option("--git-ssh-identity", help="Git config SSH identity file (key).")
-@click.option("--helm-repo-url", required=True, help="Helm repo URL.")
+@click.option(
+    "--git-workdir",
+    help="Persistent directory of the git checkout, reused across restarts.",
+)
+@click.option(
+    "--git-backend",
+    type=click.Choice(["subprocess", "dulwich"]),
+    default="subprocess",
+    show_default=True,
+    help="Run local git operations as git commands or in-process with dulwich "
+    "(installed separately).",
+)
+@click.option(
+    "--git-bare/--no-git-bare",
+    default=False,
+    show_default=True,
+    help="Work in a bare clone, without checking out any files.",
+)
+@click.option(
+    "--git-depth",
+    type=int,
+    help="Clone only this many most recent commits of the branch.",
+)
+@click.option(
+    "--git-blobless/--no-git-blobless",
+    default=False,
+    show_default=True,
+    help="Partial clone, fetching file contents only when checked out.",
+)
+@click.option(
+    "--git-sparse/--no-git-sparse",
+    default=False,
+    show_default=True,
+    help="Check out only --git-path.",
+)
+@click.option(
+    "--helm-repo-url",
+    help="Default Helm repo URL, optionally followed by comma-separated mirror URLs.",
+)
+@click.option(
+    "--helm-repo-source",
+    multiple=True,
+    help="Helm repo URL(s) of a HelmRelease sourceRef, as [NAMESPACE/]NAME=URL[,MIRROR...].",
+)
+@click.option(
+    "--helm-repo-hedge-delay",
+    default=0.5,
+    show_default=True,
+    help="Delay before asking the next Helm repo mirror (seconds).",
+)
 @click.option("--helm-repo-user", help="Helm repo HTTP Auth user.")
 @click.option(
     "--helm-repo-password",
     help="Helm repo HTTP Auth password.",
     default=lambda: os.environ.get("HELM_REPO_PASSWORD", ""),
 )
+@click.option(
+    "--helm-repo-type",
+    type=click.Choice(["index", "chartmuseum"]),
+    default="index",
+    show_default=True,
+    help="Download the whole index or per-chart ChartMuseum API.",
+)
+@click.option(
+    "--helm-repo-index-path",
+    default="index.yaml",
+    show_default=True,
+    help="Path of the chart index within the Helm repo (YAML or JSON).",
+)
+@click.option(
+    "--helm-repo-selective/--no-helm-repo-selective",
+    default=False,
+    show_default=True,
+    help="Parse only charts referenced by annotated manifests.",
+)
+@click.option(
+    "--helm-repo-cache-dir",
+    help="Directory to persist the parsed Helm repo index across restarts.",
+)
+@click.option(
+    "--helm-repo-connect-timeout",
+    default=5.0,
+    show_default=True,
+    help="Helm repo connect timeout (seconds).",
+)
+@click.option(
+    "--helm-repo-read-timeout",
+    default=30.0,
+    show_default=True,
+    help="Helm repo read timeout (seconds).",
+)
+@click.option(
+    "--helm-repo-retries",
+    default=3,
+    show_default=True,
+    help="Number of retries of failed Helm repo requests.",
+)
+@click.option(
+    "--helm-repo-retry-backoff",
+    default=0.5,
+    show_default=True,
+    help="Backoff factor between Helm repo retries (seconds).",
+)
 @click.option(
     "--sync-interval",
     default=60,
@@ -74,6 +175,25 @@ def healthz():
     show_default=True,
     help="Prefix of k8s annotations.",
 )
+@click.option(
+    "--manifest-write-mode",
+    type=click.Choice(["roundtrip", "patch"]),
+    default="roundtrip",
+    show_default=True,
+    help="Re-serialize updated manifests or patch changed values in place.",
+)
+@click.option(
+    "--manifest-workers",
+    default=1,
+    show_default=True,
+    help="Number of processes evaluating manifests.",
+)
+@click.option(
+    "--batch-commits/--no-batch-commits",
+    default=False,
+    show_default=True,
+    help="Commit all manifests updated in one sync in a single commit.",
+)
 def chart_updater(
     git_url,
     git_branch,
@@ -82,23 +202,96 @@ def chart_updater(
     git_email,
     git_timeout,
     git_ssh_identity,
+    git_workdir,
+    git_backend,
+    git_bare,
+    git_depth,
+    git_blobless,
+    git_sparse,
     helm_repo_url,
+    helm_repo_source,
+    helm_repo_hedge_delay,
     helm_repo_user,
     helm_repo_password,
+    helm_repo_type,
+    helm_repo_index_path,
+    helm_repo_selective,
+    helm_repo_cache_dir,
+    helm_repo_connect_timeout,
+    helm_repo_read_timeout,
+    helm_repo_retries,
+    helm_repo_retry_backoff,
     sync_interval,
     annotation_prefix,
+    manifest_write_mode,
+    manifest_workers,
+    batch_commits,
 ):
-    git = Git(
-        git_url,
-        git_branch,
-        git_path,
-        git_user,
-        git_email,
-        git_timeout,
-        git_ssh_identity,
+    git_class = DulwichGit if git_backend == "dulwich" else Git
+    try:
+        git = git_class(
+            git_url,
+            git_branch,
+            git_path,
+            git_user,
+            git_email,
+            git_timeout,
+            git_ssh_identity,
+            git_depth,
+            git_blobless,
+            git_sparse,
+            git_workdir,
+            git_bare,
+        )
+    except UpdateException as e:
+        raise click.UsageError(str(e))
+    if not helm_repo_url and not helm_repo_source:
+        raise click.UsageError("--helm-repo-url or --helm-repo-source is required.")
+
+    helm_repo_class = ChartMuseumRepo if helm_repo_type == "chartmuseum" else HelmRepo
+    helm_repos_by_url = {}
+
+    def helm_repo(urls):
+        if urls not in helm_repos_by_url:
+            url, *mirror_urls = urls.split(",")
+            helm_repos_by_url[urls] = helm_repo_class(
+                url,
+                helm_repo_user,
+                helm_repo_password,
+                helm_repo_connect_timeout,
+                helm_repo_read_timeout,
+                helm_repo_retries,
+                helm_repo_retry_backoff,
+                helm_repo_index_path,
+                helm_repo_selective,
+                helm_repo_cache_dir,
+                mirror_urls,
+                helm_repo_hedge_delay,
+            )
+        return helm_repos_by_url[urls]
+
+    helm_repos = {}
+    for source in helm_repo_source:
+        ref, separator, url = source.partition("=")
+        if not separator or not ref or not url:
+            raise click.BadParameter(
+                f"{source} is not in [NAMESPACE/]NAME=URL[,MIRROR...] format",
+                param_hint="--helm-repo-source",
+            )
+        helm_repos[ref] = helm_repo(url)
+    chart = helm_repo(helm_repo_url) if helm_repo_url else None
+    updater = Updater(
+        git,
+        chart,
+        sync_interval,
+        annotation_prefix,
+        event=event,
+        helm_repos=helm_repos,
+        rescan_event=rescan_event,
+        write_mode=manifest_write_mode,
+        manifest_workers=manifest_workers,
+        batch_commits=batch_commits,
     )
-    chart = HelmRepo(helm_repo_url, helm_repo_user, helm_repo_password)
-    updater = Updater(git, chart, sync_interval, annotation_prefix, event=event)
     updater.start()
     serve(app, host="0.0.0.0", port=3030)
 
@@ -0,0 +1,196 @@
+import time
+from fnmatch import fnmatchcase
+from os import path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from . import UpdateException
+from .git import Git
+
+# dulwich is an optional dependency, only needed by this backend
+try:
+    from dulwich import porcelain
+    from dulwich.diff_tree import tree_changes
+    from dulwich.graph import can_fast_forward
+    from dulwich.object_store import (
+        commit_tree_changes,
+        iter_tree_contents,
+        tree_lookup_path,
+    )
+    from dulwich.objects import S_ISGITLINK, Blob, Commit
+    from dulwich.repo import Repo
+except ImportError:
+    Repo = None
+
+
+class DulwichGit(Git):
+    # Runs operations on the local repository in-process with dulwich instead
+    # of a git process per command. Clone, fetch, ls-remote, push and the
+    # worktree reset still run git, which handles authentication, partial and
+    # sparse clones.
+
+    def __init__(self, *args, **kwargs):
+        if Repo is None:
+            raise UpdateException(
+                "The dulwich git backend requires dulwich: pip install 'dulwich>=0.21'"
+            )
+        super().__init__(*args, **kwargs)
+        self._repo = None
+
+    @property
+    def repo(self) -> "Repo":
+        if self._repo is None:
+            self._repo = Repo(self._git_dir or ".")
+        return self._repo
+
+    def close(self) -> None:
+        super().close()
+        if self._repo is not None:
+            self._repo.close()
+            self._repo = None
+
+    def update_branch(self) -> None:
+        super().update_branch()
+        # Objects and refs fetched by git are picked up by a fresh repository
+        self.close()
+
+    def head(self) -> str:
+        return self.repo.head().decode()
+
+    def _tracked_blobs(self) -> Iterator[Tuple[str, bytes]]:
+        # Submodules and conflicting index entries are skipped
+        if self.git_bare:
+            entries = (
+                (entry.path, entry)
+                for entry in iter_tree_contents(
+                    self.repo.object_store, self._head_tree()
+                )
+            )
+        else:
+            entries = self.repo.open_index().items()
+        for path_, entry in entries:
+            if hasattr(entry, "sha") and not S_ISGITLINK(entry.mode):
+                yield path_.decode(), entry.sha
+
+    def _head_tree(self) -> bytes:
+        return self.repo[self.repo.head()].tree
+
+    def blob_ids(self, paths: List[str]) -> Dict[str, str]:
+        if not paths:
+            return {}
+        blob_ids = {}
+        if self.git_bare:
+            tree = self._head_tree()
+            for path_ in paths:
+                try:
+                    _, sha = tree_lookup_path(
+                        self.repo.__getitem__, tree, path_.encode()
+                    )
+                except KeyError:
+                    continue
+                blob_ids[path_] = sha.decode()
+        else:
+            index = self.repo.open_index()
+            for path_ in paths:
+                try:
+                    entry = index[path_.encode()]
+                except KeyError:
+                    continue
+                if hasattr(entry, "sha"):
+                    blob_ids[path_] = entry.sha.decode()
+        return blob_ids
+
+    def read_files(self, paths: List[str]) -> Dict[str, str]:
+        if not self.git_bare:
+            return super().read_files(paths)
+        texts = {
+            path_: self._decode(path_, self._blob_data(blob_id.encode()))
+            for path_, blob_id in self.blob_ids(paths).items()
+        }
+        return {path_: text for path_, text in texts.items() if text is not None}
+
+    def _blob_data(self, blob_id: bytes) -> bytes:
+        # Blobs missing from a partial clone are fetched by git
+        try:
+            return self.repo.object_store[blob_id].data
+        except KeyError:
+            with self._cat_file_lock:
+                return super()._read_blob(blob_id.decode())
+
+    def is_ancestor(self, ancestor: str, commit: str) -> bool:
+        try:
+            return can_fast_forward(self.repo, ancestor.encode(), commit.encode())
+        except KeyError:
+            return False
+
+    def changed_files(self, old: str, new: str) -> List[str]:
+        changed = set()
+        for change in tree_changes(
+            self.repo.object_store,
+            self.repo[old.encode()].tree,
+            self.repo[new.encode()].tree,
+        ):
+            for entry in (change.old, change.new):
+                if entry is not None and entry.path is not None:
+                    changed.add(entry.path.decode())
+        return sorted(self._matching(changed, self.manifest_pathspecs()))
+
+    @staticmethod
+    def _matching(paths, pathspecs: List[str]) -> Iterator[str]:
+        # Pathspecs are matched like git does without magic, * also matches /
+        pathspecs = [path.normpath(pathspec) for pathspec in pathspecs]
+        return (
+            path_
+            for path_ in paths
+            if any(fnmatchcase(path_, pathspec) for pathspec in pathspecs)
+        )
+
+    def grep(
+        self, patterns: List[str], pathspecs: Optional[List[str]] = None
+    ) -> List[str]:
+        blobs = dict(self._tracked_blobs())
+        needles = [pattern.encode() for pattern in patterns]
+        found = []
+        for path_ in self._matching(blobs, pathspecs or self.manifest_pathspecs()):
+            if self.git_bare:
+                content = self._blob_data(blobs[path_])
+            else:
+                try:
+                    with open(path.join(self.repo.path, path_), "rb") as f:
+                        content = f.read()
+                except OSError:
+                    continue
+            if all(needle in content for needle in needles):
+                found.append(path_)
+        return sorted(found)
+
+    def _commit_files(self, files: Dict[str, str], commit_message: str) -> None:
+        if self.git_bare:
+            changes = []
+            for path_, text in files.items():
+                blob = Blob.from_string(text.encode())
+                self.repo.object_store.add_object(blob)
+                changes.append((path_.encode(), 0o100644, blob.id))
+            tree = commit_tree_changes(
+                self.repo.object_store, self._head_tree(), changes
+            )
+        else:
+            self._write_files(files)
+            porcelain.add(
+                self.repo, [path.join(self.repo.path, path_) for path_ in files]
+            )
+            tree = self.repo.open_index().commit(self.repo.object_store)
+        self._commit_tree(tree, commit_message)
+
+    def _commit_tree(self, tree: bytes, commit_message: str) -> None:
+        parent = self.repo.head()
+        identity = f"{self.git_user} <{self.git_email}>".encode()
+        commit = Commit()
+        commit.tree = tree
+        commit.parents = [parent]
+        commit.author = commit.committer = identity
+        commit.author_time = commit.commit_time = int(time.time())
+        commit.author_timezone = commit.commit_timezone = time.localtime().tm_gmtoff
+        commit.message = commit_message.rstrip("\n").encode() + b"\n"
+        self.repo.object_store.add_object(commit)
+        if not self.repo.refs.set_if_equals(b"HEAD", parent, commit.id):
+            raise UpdateException("Cannot commit: HEAD changed concurrently")
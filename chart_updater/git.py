@@ -1,13 +1,77 @@
 import logging
+import shutil
 import tempfile
-from os import chdir, environ, path
-from subprocess import PIPE, STDOUT, run
-from typing import List, Optional
+from os import chdir, environ, listdir, path, read, remove
+from select import select
+from subprocess import PIPE, STDOUT, Popen, TimeoutExpired, run
+from threading import Lock
+from time import monotonic
+from typing import Dict, List, Optional, Protocol, runtime_checkable
 
 from chart_updater import UpdateException
 
 log = logging.getLogger("chart-updater")
 
+MANIFEST_GLOBS = ("*.yaml", "*.yml")
+
+
+@runtime_checkable
+class GitBackend(Protocol):
+    # The operations the updater runs on the config repository. Git runs them
+    # as git commands, DulwichGit overrides the local ones to run in-process.
+    # Paths are relative to the repository root and commits are hex ids.
+
+    def clone_repo(self) -> None:
+        # Clones the configured branch, or reuses a matching existing clone
+        ...
+
+    def update_branch(self) -> None:
+        # Moves the local branch to the remote one, dropping local commits
+        ...
+
+    def remote_head(self) -> Optional[str]:
+        # The remote branch head without fetching, None without the branch
+        ...
+
+    def head(self) -> str:
+        ...
+
+    def blob_ids(self, paths: List[str]) -> Dict[str, str]:
+        # Blob ids of the paths in HEAD, untracked paths are left out
+        ...
+
+    def read_files(self, paths: List[str]) -> Dict[str, str]:
+        # Texts of the paths, unreadable or undecodable files are left out
+        ...
+
+    def grep(
+        self, patterns: List[str], pathspecs: Optional[List[str]] = None
+    ) -> List[str]:
+        # Sorted manifest paths containing all the fixed-string patterns
+        ...
+
+    def manifest_pathspecs(self) -> List[str]:
+        ...
+
+    def is_ancestor(self, ancestor: str, commit: str) -> bool:
+        ...
+
+    def changed_files(self, old: str, new: str) -> List[str]:
+        # Sorted manifest paths which differ between the commits
+        ...
+
+    def commit_files(self, files: Dict[str, str], commit_message: str) -> None:
+        # Commits the texts of the files on top of HEAD in one commit. A failed
+        # commit leaves no changes behind and raises UpdateException.
+        ...
+
+    def push_to_branch(self) -> None:
+        ...
+
+    def close(self) -> None:
+        # Releases resources like long-lived processes, the backend stays usable
+        ...
+
 
 class Git:
     def __init__(
@@ -19,6 +83,11 @@ class Git:
         git_email: str = "git@rossum.ai",
         git_timeout: int = 30,
         git_ssh_identity: Optional[str] = None,
+        git_depth: Optional[int] = None,
+        git_blobless: bool = False,
+        git_sparse: bool = False,
+        git_workdir: Optional[str] = None,
+        git_bare: bool = False,
     ):
         self.git_url = git_url
         self.git_ref = git_ref
@@ -27,20 +96,42 @@ class Git:
         self.git_email = git_email
         self.git_timeout = git_timeout
         self.git_ssh_identity = git_ssh_identity
+        self.git_depth = git_depth
+        self.git_blobless = git_blobless
+        self.git_sparse = git_sparse
+        self.git_workdir = git_workdir
+        # A bare repository has no files checked out, manifests are read and
+        # committed through git objects only.
+        self.git_bare = git_bare
         self._git_dir = None
-
-    def _run(self, command: List[str], max_ok_returncode: int = 0) -> str:
-        log.debug("Running command: {' '.join(command)}")
-        env_copy = {
-            **environ.copy(),
+        self._cat_file = None
+        self._cat_file_output = bytearray()
+        self._cat_file_lock = Lock()
+        self._base_env = {
+            **environ,
             "GIT_SSH_COMMAND": f"ssh -i {self.git_ssh_identity} -o StrictHostKeyChecking=yes",
         }
+
+    def _env(self, **extra: str) -> Dict[str, str]:
+        return {**self._base_env, **extra} if extra else self._base_env
+
+    def _run(
+        self,
+        command: List[str],
+        max_ok_returncode: int = 0,
+        input_text: Optional[str] = None,
+        env: Optional[Dict[str, str]] = None,
+    ) -> str:
+        log.debug("Running command: {' '.join(command)}")
+        # Commands run in the clone without relying on the current directory
         result = run(
             self._expand_env_vars(command),
             stdout=PIPE,
             stderr=STDOUT,
             text=True,
-            env=env_copy,
+            input=input_text,
+            env=env or self._env(),
+            cwd=self._git_dir,
             timeout=self.git_timeout,
         )
         if result.returncode > max_ok_returncode:
@@ -53,29 +144,345 @@ class Git:
     def _expand_env_vars(command: List[str]) -> List[str]:
         return [path.expandvars(part) for part in command]
 
-    def clone_repo(self) -> None:
-        self._git_dir = tempfile.mkdtemp()
-        self._run(
-            ["git", "clone", self.git_url, "--branch", self.git_ref, self._git_dir]
+    def _clone_options(self) -> List[str]:
+        options = ["--single-branch"]
+        if self.git_bare:
+            options.append("--bare")
+        if self.git_depth:
+            options += ["--depth", str(self.git_depth)]
+        if self.git_blobless:
+            options.append("--filter=blob:none")
+        if self._sparse_checkout():
+            options.append("--sparse")
+        return options
+
+    def _sparse_checkout(self) -> bool:
+        return (
+            self.git_sparse
+            and not self.git_bare
+            and path.normpath(self.git_path) != "."
+        )
+
+    def _is_git_dir(self, git_dir: str) -> bool:
+        if self.git_bare:
+            return path.isfile(path.join(git_dir, "HEAD")) and path.isdir(
+                path.join(git_dir, "objects")
+            )
+        return path.isdir(path.join(git_dir, ".git"))
+
+    def _is_reusable(self, git_dir: str) -> bool:
+        # An existing checkout is reused only if it is a clean checkout of the
+        # configured branch from the configured remote, cloned with the
+        # configured history and blob filter.
+        if not self._is_git_dir(git_dir):
+            return False
+        try:
+            git_url = self._run(["git", "-C", git_dir, "remote", "get-url", "origin"])
+            branch = self._run(
+                ["git", "-C", git_dir, "symbolic-ref", "--short", "HEAD"]
+            )
+            shallow = self._run(
+                ["git", "-C", git_dir, "rev-parse", "--is-shallow-repository"]
+            )
+            blob_filter = self._run(
+                ["git", "-C", git_dir, "config", "remote.origin.partialclonefilter"],
+                max_ok_returncode=1,
+            )
+            status = ""
+            if not self.git_bare:
+                status = self._run(["git", "-C", git_dir, "status", "--porcelain"])
+        except UpdateException as e:
+            log.info(f"Cannot reuse checkout in {git_dir}: {str(e)}")
+            return False
+        if git_url.strip() != path.expandvars(self.git_url):
+            log.info(f"Checkout in {git_dir} is cloned from another repository")
+            return False
+        if branch.strip() != self.git_ref:
+            log.info(f"Checkout in {git_dir} is not on branch {self.git_ref}")
+            return False
+        if status.strip():
+            log.info(f"Checkout in {git_dir} has local changes")
+            return False
+        if (shallow.strip() == "true") != bool(self.git_depth):
+            log.info(f"Checkout in {git_dir} has another history depth")
+            return False
+        if (blob_filter.strip() == "blob:none") != self.git_blobless:
+            log.info(f"Checkout in {git_dir} has another blob filter")
+            return False
+        return True
+
+    def _sparse_enabled(self) -> bool:
+        output = self._run(
+            ["git", "config", "--bool", "core.sparseCheckout"], max_ok_returncode=1
         )
-        chdir(self._git_dir)
+        return output.strip() == "true"
+
+    def _clear_workdir(self, git_dir: str) -> None:
+        if not path.exists(git_dir) or not listdir(git_dir):
+            return
+        if not self._is_git_dir(git_dir):
+            raise UpdateException(
+                f"Cannot clone into {git_dir}: not empty and not a git checkout"
+            )
+        # The directory itself is kept, it is typically a volume mount point
+        for name in listdir(git_dir):
+            entry = path.join(git_dir, name)
+            if path.isdir(entry) and not path.islink(entry):
+                shutil.rmtree(entry)
+            else:
+                remove(entry)
+
+    def clone_repo(self) -> None:
+        # A valid checkout in git_workdir is reused, update_branch fetches it
+        self.close()
+        reuse = bool(self.git_workdir) and self._is_reusable(self.git_workdir)
+        if reuse:
+            log.info(f"Reusing checkout in {self.git_workdir}")
+            git_dir = self.git_workdir
+        elif self.git_workdir:
+            self._clear_workdir(self.git_workdir)
+            git_dir = self.git_workdir
+        else:
+            git_dir = tempfile.mkdtemp()
+        if not reuse:
+            self._run(
+                ["git", "clone", self.git_url, "--branch", self.git_ref]
+                + self._clone_options()
+                + [git_dir]
+            )
+        self._git_dir = git_dir
+        if not self.git_bare:
+            chdir(self._git_dir)
         self._run(["git", "config", "user.name", self.git_user])
         self._run(["git", "config", "user.email", self.git_email])
+        # A reused checkout may have been cloned with other sparse settings
+        if self._sparse_checkout():
+            self._run(["git", "sparse-checkout", "set", self.git_path])
+        elif reuse and not self.git_bare and self._sparse_enabled():
+            self._run(["git", "sparse-checkout", "disable"])
 
     def update_branch(self) -> None:
-        self._run(["git", "fetch", "origin"])
-        self._run(["git", "reset", "--hard", f"origin/{self.git_ref}"])
+        # Only the configured branch is fetched. A shallow clone is not deepened,
+        # new commits are fetched on top of the history it already has.
+        self._run(["git", "fetch", "origin", self._branch_refspec()])
+        if self.git_bare:
+            self._run(
+                ["git", "update-ref", f"refs/heads/{self.git_ref}"]
+                + [f"refs/remotes/origin/{self.git_ref}"]
+            )
+        else:
+            self._run(["git", "reset", "--hard", f"origin/{self.git_ref}"])
+
+    def remote_head(self) -> Optional[str]:
+        output = self._run(["git", "ls-remote", "origin", f"refs/heads/{self.git_ref}"])
+        return output.split()[0] if output.strip() else None
+
+    def _branch_refspec(self) -> str:
+        return f"+refs/heads/{self.git_ref}:refs/remotes/origin/{self.git_ref}"
+
+    def head(self) -> str:
+        return self._run(["git", "rev-parse", "HEAD"]).strip()
+
+    def blob_ids(self, paths: List[str]) -> Dict[str, str]:
+        if not paths:
+            return {}
+        if self.git_bare:
+            output = self._run(["git", "ls-tree", "-r", "-z", "HEAD", "--", *paths])
+        else:
+            output = self._run(["git", "ls-files", "-s", "-z", "--", *paths])
+        blob_ids = {}
+        for entry in filter(None, output.split("\0")):
+            info, path_ = entry.split("\t", 1)
+            blob_ids[path_] = info.split()[2 if self.git_bare else 1]
+        return blob_ids
+
+    def read_files(self, paths: List[str]) -> Dict[str, str]:
+        # Files which cannot be read or decoded are left out
+        if not self.git_bare:
+            texts = {path_: self._read_file(path_) for path_ in paths}
+        else:
+            blob_ids = self.blob_ids(paths)
+            with self._cat_file_lock:
+                texts = {
+                    path_: self._decode(path_, self._read_blob(blob_ids[path_]))
+                    for path_ in paths
+                    if path_ in blob_ids
+                }
+        return {path_: text for path_, text in texts.items() if text is not None}
+
+    def _read_file(self, path_: str) -> Optional[str]:
+        try:
+            with open(path.join(self._git_dir or ".", path_), "rb") as f:
+                return self._decode(path_, f.read())
+        except OSError as e:
+            log.info(f"Cannot read {path_}: {str(e)}")
+            return None
+
+    @staticmethod
+    def _decode(path_: str, content: bytes) -> Optional[str]:
+        try:
+            return content.decode()
+        except UnicodeDecodeError as e:
+            log.info(f"Cannot read {path_}: {str(e)}")
+            return None
+
+    def _read_blob(self, blob_id: str) -> bytes:
+        # Blobs are streamed from a single long-lived cat-file process. It is
+        # restarted by the next read when it fails or does not answer in time.
+        if self._cat_file is None:
+            self._cat_file = Popen(
+                ["git", "cat-file", "--batch"],
+                stdin=PIPE,
+                stdout=PIPE,
+                bufsize=0,
+                env=self._env(),
+                cwd=self._git_dir,
+            )
+            self._cat_file_output = bytearray()
+        deadline = monotonic() + self.git_timeout
+        try:
+            self._cat_file.stdin.write(f"{blob_id}\n".encode())
+            header = self._read_cat_file(None, deadline).decode().split()
+            if len(header) != 3:
+                raise UpdateException(f"Cannot read git object {blob_id}: {header}")
+            content = self._read_cat_file(int(header[2]) + 1, deadline)
+        except OSError as e:
+            self._kill_cat_file()
+            raise UpdateException(f"Cannot read git object {blob_id}: {str(e)}")
+        except UpdateException:
+            self._kill_cat_file()
+            raise
+        return content[:-1]
+
+    def _read_cat_file(self, size: Optional[int], deadline: float) -> bytes:
+        # Reads a line if size is None, waiting at most until the deadline
+        output = self._cat_file_output
+        stdout = self._cat_file.stdout.fileno()
+        while True:
+            if size is None:
+                end = output.find(b"\n") + 1
+            else:
+                end = size if len(output) >= size else 0
+            if end:
+                data = bytes(output[:end])
+                del output[:end]
+                return data
+            timeout = deadline - monotonic()
+            if timeout <= 0 or not select([stdout], [], [], timeout)[0]:
+                raise UpdateException(
+                    f"git cat-file did not answer in {self.git_timeout} seconds"
+                )
+            chunk = read(stdout, 65536)
+            if not chunk:
+                raise UpdateException("git cat-file exited unexpectedly")
+            output += chunk
+
+    def _kill_cat_file(self) -> None:
+        self._cat_file.kill()
+        self._cat_file.wait()
+        self._cat_file = None
+
+    def close(self) -> None:
+        if self._cat_file is not None:
+            self._cat_file.stdin.close()
+            try:
+                self._cat_file.wait(self.git_timeout)
+            except TimeoutExpired:
+                self._cat_file.kill()
+                self._cat_file.wait()
+            self._cat_file = None
+
+    def is_ancestor(self, ancestor: str, commit: str) -> bool:
+        output = self._run(["git", "merge-base", ancestor, commit], max_ok_returncode=1)
+        return output.strip() == ancestor
+
+    def changed_files(self, old: str, new: str) -> List[str]:
+        output = self._run(
+            ["git", "diff", "--name-only", "-z", "--no-renames", old, new, "--"]
+            + self.manifest_pathspecs()
+        )
+        return sorted(filter(None, output.split("\0")))
 
     def push_to_branch(self) -> None:
         self._run(["git", "push", "origin", self.git_ref])
 
-    def update_file(self, path_: str, commit_message: str) -> None:
-        self._run(["git", "add", path_])
-        self._run(["git", "commit", "-m", commit_message])
+    def commit_files(self, files: Dict[str, str], commit_message: str) -> None:
+        try:
+            self._commit_files(files, commit_message)
+        except Exception:
+            # Written files and staged entries of a failed commit would
+            # otherwise end up in the next one
+            if not self.git_bare:
+                self._reset_worktree()
+            raise
+
+    def _reset_worktree(self) -> None:
+        try:
+            self._run(["git", "reset", "-q", "--hard", "HEAD"])
+        except UpdateException as e:
+            log.error(f"Cannot reset worktree: {str(e)}")
+
+    def _commit_files(self, files: Dict[str, str], commit_message: str) -> None:
+        # A single file in a worktree is committed with the porcelain in two
+        # processes. Otherwise all the files are committed at once through the
+        # index and tree plumbing, with a number of git processes independent
+        # of the number of files.
+        if not self.git_bare and len(files) == 1:
+            self._write_files(files)
+            self._run(["git", "add", "--", *files])
+            self._run(["git", "commit", "-q", "-m", commit_message])
+            return
+        if self.git_bare:
+            tree = self._write_bare_tree(files)
+        else:
+            self._write_files(files)
+            self._run(["git", "update-index", "--add", "--", *files])
+            tree = self._run(["git", "write-tree"]).strip()
+        commit = self._run(
+            ["git", "commit-tree", tree, "-p", "HEAD", "-m", commit_message]
+        ).strip()
+        self._run(["git", "update-ref", "-m", "commit: chart update", "HEAD", commit])
+
+    def _write_files(self, files: Dict[str, str]) -> None:
+        for path_, text in files.items():
+            try:
+                with open(path.join(self._git_dir or ".", path_), "w", newline="") as f:
+                    f.write(text)
+            except OSError as e:
+                raise UpdateException(f"Cannot update manifest {path_}: {str(e)}")
+
+    def _write_bare_tree(self, files: Dict[str, str]) -> str:
+        # The tree is built in a temporary index, starting from HEAD
+        index_info = ""
+        for path_, text in files.items():
+            blob_id = self._run(
+                ["git", "hash-object", "-w", "--stdin"], input_text=text
+            ).strip()
+            index_info += f"100644 {blob_id}\t{path_}\n"
+        with tempfile.TemporaryDirectory() as index_dir:
+            env = self._env(GIT_INDEX_FILE=path.join(index_dir, "index"))
+            self._run(["git", "read-tree", "HEAD"], env=env)
+            self._run(
+                ["git", "update-index", "--index-info"], input_text=index_info, env=env
+            )
+            return self._run(["git", "write-tree"], env=env).strip()
+
+    def manifest_pathspecs(self) -> List[str]:
+        return [path.join(self.git_path, glob) for glob in MANIFEST_GLOBS]
 
-    def grep(self, pattern: str, path: str = None) -> List[str]:
-        path = path or self.git_path
+    def grep(
+        self, patterns: List[str], pathspecs: Optional[List[str]] = None
+    ) -> List[str]:
+        # Lists files containing all the fixed-string patterns in a single pass
+        pattern_args = [arg for pattern in patterns for arg in ("-e", pattern)]
+        # A bare repository is searched in the HEAD tree instead of the worktree
+        revision = ["HEAD"] if self.git_bare else []
         output = self._run(
-            ["git", "grep", "-l", pattern, "--", path], max_ok_returncode=1
+            ["git", "grep", "-l", "-z", "-F", "--all-match", *pattern_args]
+            + [*revision, "--", *(pathspecs or self.manifest_pathspecs())],
+            max_ok_returncode=1,
         )
-        return list(filter(None, output.split("\n")))
+        paths = filter(None, output.split("\0"))
+        if self.git_bare:
+            paths = (path_[len("HEAD:") :] for path_ in paths)
+        return sorted(paths)
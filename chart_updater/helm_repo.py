@@ -1,76 +1,582 @@
-import fnmatch
+import hashlib
+import json
 import logging
+import os
+import pickle
 import re
-from typing import Tuple
+import resource
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from typing import (
+    IO,
+    AbstractSet,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+from urllib.parse import quote
 
 import requests
-import semantic_version
 import yaml
 from requests import RequestException
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
 
 from chart_updater import UpdateException
+from chart_updater.version_pattern import compile_version_pattern, parse_semver
 
 log = logging.getLogger("chart-updater")
 
+INDEX_CACHE_VERSION = 3
+INDEX_CHUNK_SIZE = 64 * 1024
+INDEX_SPOOL_SIZE = 1024 * 1024
+# Weight of the latest sample in the moving average of mirror latencies
+LATENCY_WEIGHT = 0.3
+
+# PyYAML built with libyaml parses large indexes several times faster.
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+CREATED_RE = re.compile(
+    r"^(?P<datetime>\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?P<fraction>\.\d+)?(?P<tz>Z|[+-]\d\d:?\d\d)?$"
+)
+
+
+def parse_created(created) -> float:
+    if isinstance(created, datetime):
+        timestamp = created
+    else:
+        match = CREATED_RE.match(str(created).strip())
+        if not match:
+            return float("-inf")
+        fraction = f".{(match['fraction'] or '.')[1:7]:0<6}"
+        tz = match["tz"] or "Z"
+        if tz == "Z":
+            tz = "+00:00"
+        elif ":" not in tz:
+            tz = f"{tz[:3]}:{tz[3:]}"
+        timestamp = datetime.fromisoformat(f"{match['datetime']}{fraction}{tz}")
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.timestamp()
+
+
+def conditional_headers(etag: Optional[str], last_modified: Optional[str]) -> dict:
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+
+def close_response(future: Future) -> None:
+    if future.exception() is None:
+        future.result().close()
+
+
+def peak_rss() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def select_index_entries(
+    lines: Iterable[bytes], chart_names: AbstractSet[str]
+) -> Optional[bytes]:
+    # Cut the block-style "entries" mapping of an index generated by Helm down to
+    # the given charts, so that the others are never parsed. Returns None when
+    # the layout is not recognized and the whole index has to be parsed.
+    lines = iter(lines)
+    if not any(line.rstrip() == b"entries:" for line in lines):
+        return None
+
+    selected = [b"entries:\n"]
+    child_indent = None
+    keep = False
+    for line in lines:
+        stripped = line.strip()
+        if not stripped or stripped.startswith(b"#"):
+            if keep:
+                selected.append(line)
+            continue
+        indent = len(line) - len(line.lstrip(b" "))
+        if child_indent is None:
+            if indent == 0:
+                return None
+            child_indent = indent
+        if indent < child_indent:
+            if indent == 0 and not stripped.startswith(b"-"):
+                break
+            return None
+        if indent == child_indent and not stripped.startswith(b"-"):
+            key, separator, _ = stripped.partition(b":")
+            if not separator:
+                return None
+            keep = key.strip(b"'\"").decode() in chart_names
+        if keep:
+            selected.append(line)
+    return b"".join(selected)
+
+
+class ChartVersion:
+    __slots__ = ("version", "app_version", "created", "semver")
+
+    def __init__(self, version: str, app_version: Optional[str], created: float):
+        self.version = version
+        self.app_version = app_version
+        self.created = created
+        self.semver = parse_semver(version)
+
+    @classmethod
+    def from_index_entry(cls, entry: dict) -> "ChartVersion":
+        app_version = entry.get("appVersion")
+        return cls(
+            str(entry["version"]),
+            None if app_version is None else str(app_version),
+            parse_created(entry.get("created")),
+        )
+
+    def sort_key(self) -> tuple:
+        # Newer creation time first, semver precedence breaks ties
+        return (self.created, self.semver is not None, self.semver)
+
+    def __eq__(self, other):
+        if not isinstance(other, ChartVersion):
+            return NotImplemented
+        return self.__getstate__() == other.__getstate__()
+
+    def __hash__(self):
+        return hash(self.__getstate__())
+
+    def __getstate__(self):
+        return (self.version, self.app_version, self.created)
+
+    def __setstate__(self, state):
+        self.version, self.app_version, self.created = state
+        self.semver = parse_semver(self.version)
+
+    def __repr__(self):
+        return f"ChartVersion({self.version!r}, {self.app_version!r}, {self.created!r})"
+
 
 class HelmRepo:
-    def __init__(self, helm_repo_url: str, user=None, password=None):
-        self._user = user
-        self._password = password
+    def __init__(
+        self,
+        helm_repo_url: str,
+        user=None,
+        password=None,
+        connect_timeout: float = 5,
+        read_timeout: float = 30,
+        retries: int = 3,
+        retry_backoff: float = 0.5,
+        index_path: str = "index.yaml",
+        selective: bool = False,
+        cache_dir: Optional[str] = None,
+        mirror_urls: Sequence[str] = (),
+        hedge_delay: float = 0.5,
+    ):
         self.helm_repo_url = helm_repo_url
-        self._index = None
+        self.index_path = index_path
+        self.selective = selective
+        self.mirror_urls = [url for url in mirror_urls if url != helm_repo_url]
+        self.hedge_delay = hedge_delay
+        self._timeout = (connect_timeout, read_timeout)
+        self._session = self._create_session(user, password, retries, retry_backoff)
+        self._latency = {}
+        self._hedge_executor = None
+        self._index_source = helm_repo_url
+        self._catalog = None
+        self._loaded_charts = None
+        self._resolved = {}
+        self._etag = None
+        self._last_modified = None
+        self._index_digest = None
+        self._cache_path = None
+        if cache_dir:
+            key = hashlib.sha256(self._cache_key().encode()).hexdigest()
+            self._cache_path = os.path.join(cache_dir, f"helm-index-{key[:16]}.pickle")
+            self._load_cache()
+
+    def _cache_key(self) -> str:
+        return f"{self.helm_repo_url}/{self.index_path}"
+
+    def _load_cache(self) -> None:
+        try:
+            with open(self._cache_path, "rb") as f:
+                cache = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            log.info(f"Cannot load chart list cache {self._cache_path}: {str(e)}")
+            return
+        if cache.get("version") != INDEX_CACHE_VERSION:
+            return
+        self._restore_cache_state(cache)
+        log.info(f"Loaded chart list from cache {self._cache_path}")
+
+    def _restore_cache_state(self, cache: dict) -> None:
+        self._catalog = cache["catalog"]
+        self._loaded_charts = cache["loaded_charts"]
+        self._etag = cache["etag"]
+        self._last_modified = cache["last_modified"]
+        self._index_digest = cache["digest"]
+        self._index_source = cache["source"]
+
+    def _cache_state(self) -> dict:
+        return {
+            "version": INDEX_CACHE_VERSION,
+            "catalog": self._catalog,
+            "loaded_charts": self._loaded_charts,
+            "etag": self._etag,
+            "last_modified": self._last_modified,
+            "digest": self._index_digest,
+            "source": self._index_source,
+        }
+
+    def _save_cache(self) -> None:
+        cache = self._cache_state()
+        cache_dir = os.path.dirname(self._cache_path)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as f:
+                pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f.name, self._cache_path)
+        except OSError as e:
+            log.info(f"Cannot save chart list cache {self._cache_path}: {str(e)}")
+
+    @staticmethod
+    def _create_session(
+        user: Optional[str], password: Optional[str], retries: int, retry_backoff: float
+    ) -> requests.Session:
+        session = requests.Session()
+        if user:
+            session.auth = HTTPBasicAuth(user, password)
+        retry = Retry(
+            total=retries,
+            backoff_factor=retry_backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("GET",),
+        )
+        adapter = HTTPAdapter(max_retries=retry)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def update(self, chart_names: Optional[Iterable[str]] = None) -> Optional[Set[str]]:
+        # Returns names of charts whose versions changed, None if all of them
+        # have to be considered changed.
+        wanted = None
+        if self.selective and chart_names is not None:
+            wanted = frozenset(chart_names)
+            if not wanted:
+                log.debug("No charts referenced, chart list not downloaded")
+                return set()
+        index = self._load_chart_repo_index(wanted)
+        if index is None:
+            return set()
+        catalog = self._build_catalog(index, wanted)
+        delta = self._catalog_delta(self._catalog, catalog)
+        self._catalog = catalog
+        self._loaded_charts = wanted
+        self._resolved = {}
+        if self._cache_path:
+            self._save_cache()
+        return delta
+
+    @staticmethod
+    def _catalog_delta(
+        old: Optional[Dict[str, List[ChartVersion]]],
+        new: Dict[str, List[ChartVersion]],
+    ) -> Optional[Set[str]]:
+        if old is None:
+            return None
+        return {
+            chart_name
+            for chart_name in old.keys() | new.keys()
+            if old.get(chart_name) != new.get(chart_name)
+        }
 
-    def update(self):
-        self._index = self._load_chart_repo_index()
+    def _has_charts(self, chart_names: Optional[AbstractSet[str]]) -> bool:
+        if self._catalog is None:
+            return False
+        if self._loaded_charts is None:
+            return True
+        return chart_names is not None and chart_names <= self._loaded_charts
+
+    @staticmethod
+    def _build_catalog(
+        index: dict, chart_names: Optional[AbstractSet[str]] = None
+    ) -> Dict[str, List[ChartVersion]]:
+        # Only the fields needed for version resolution are kept, the rest of
+        # the parsed index is dropped as soon as the catalog is built.
+        catalog = {}
+        for chart_name, charts in (index.get("entries") or {}).items():
+            if chart_names is not None and chart_name not in chart_names:
+                continue
+            catalog[chart_name] = HelmRepo._build_chart_versions(charts)
+        return catalog
+
+    @staticmethod
+    def _build_chart_versions(charts: Optional[List[dict]]) -> List[ChartVersion]:
+        return sorted(
+            (
+                ChartVersion.from_index_entry(chart)
+                for chart in charts or []
+                if "version" in chart
+            ),
+            key=ChartVersion.sort_key,
+            reverse=True,
+        )
 
     def get_latest_chart_versions(
         self, chart_name: str, chart_version_pattern: str
-    ) -> Tuple[str, str]:
-        chart = self._get_latest_chart(chart_name, chart_version_pattern)
-        return chart.get("version"), chart.get("appVersion")
+    ) -> Tuple[Optional[str], Optional[str]]:
+        key = (chart_name, chart_version_pattern)
+        if key not in self._resolved:
+            chart = self._get_latest_chart(chart_name, chart_version_pattern)
+            if chart is None:
+                self._resolved[key] = None, None
+            else:
+                self._resolved[key] = chart.version, chart.app_version
+        return self._resolved[key]
 
-    def _load_chart_repo_index(self) -> dict:
-        try:
-            if self._user:
-                response = requests.get(
-                    f"{self.helm_repo_url}/index.yaml",
-                    auth=HTTPBasicAuth(self._user, self._password),
-                )
+    def _conditional_headers(self) -> dict:
+        return conditional_headers(self._etag, self._last_modified)
+
+    def _load_chart_repo_index(
+        self, chart_names: Optional[AbstractSet[str]] = None
+    ) -> Optional[dict]:
+        # The current catalog can only be kept if it contains all requested charts
+        reusable = self._has_charts(chart_names)
+        # The body is spooled to disk while hashed, so that it is never held in
+        # memory as a whole next to the parsed index.
+        with tempfile.SpooledTemporaryFile(max_size=INDEX_SPOOL_SIZE) as body:
+            try:
+                source, response = self._get_index_response(reusable)
+                with response:
+                    if response.status_code == 304:
+                        log.debug("Chart list not modified")
+                        return None
+                    digest = hashlib.sha256()
+                    for chunk in response.iter_content(INDEX_CHUNK_SIZE):
+                        digest.update(chunk)
+                        body.write(chunk)
+                    transferred = response.raw.tell()
+                    headers = response.headers
+            except RequestException as e:
+                raise UpdateException(f"Cannot download chart list: {str(e)}")
+
+            size = body.tell()
+            digest = digest.hexdigest()
+            if reusable and digest == self._index_digest:
+                log.debug("Chart list content unchanged")
+                index = None
             else:
-                response = requests.get(f"{self.helm_repo_url}/index.yaml")
-            response.raise_for_status()
-        except RequestException as e:
-            raise UpdateException(f"Cannot download chart list: {str(e)}")
-        return yaml.safe_load(response.content)
+                body.seek(0)
+                index = self._parse_index(
+                    body, headers.get("Content-Type", ""), chart_names
+                )
+                log.info(
+                    f"Chart list downloaded: {transferred} bytes transferred, "
+                    f"{size} bytes decoded, peak RSS {peak_rss()} KiB"
+                )
 
-    def _get_latest_chart(self, chart_name: str, chart_version_pattern: str) -> dict:
+        # Validators are recorded only once the index was parsed, so that an
+        # index which failed to parse is downloaded again
+        self._etag = headers.get("ETag")
+        self._last_modified = headers.get("Last-Modified")
+        self._index_digest = digest
+        self._index_source = source
+        return index
+
+    def _get_index(self, url: str, reusable: bool) -> requests.Response:
+        headers = {
+            "Accept": "application/json, application/x-yaml;q=0.9, */*;q=0.8",
+            "Accept-Encoding": "gzip, deflate",
+        }
+        # Validators are only meaningful for the server which produced them
+        if reusable and url == self._index_source:
+            headers.update(self._conditional_headers())
+        start = time.monotonic()
         try:
-            matching_charts = []
-            charts = self._index["entries"][chart_name]
-            for chart in charts:
-                if self._chart_pattern_match(chart["version"], chart_version_pattern):
-                    matching_charts.append(chart)
-            return sorted(matching_charts, key=lambda c: c["created"])[-1]
-        except (IndexError, KeyError):
-            log.info(
-                f"No chart {chart_name} matching {chart_version_pattern} found in the Helm repository"
+            response = self._session.get(
+                f"{url}/{self.index_path}",
+                headers=headers,
+                timeout=self._timeout,
+                stream=True,
             )
-            return {}
+            response.raise_for_status()
+        except RequestException:
+            self._record_latency(url, self._timeout[1])
+            raise
+        self._record_latency(url, time.monotonic() - start)
+        return response
 
-    @staticmethod
-    def _chart_pattern_match(version: str, pattern: str) -> bool:
+    def _record_latency(self, url: str, latency: float) -> None:
+        previous = self._latency.get(url)
+        if previous is not None:
+            latency = previous * (1 - LATENCY_WEIGHT) + latency * LATENCY_WEIGHT
+        self._latency[url] = latency
+
+    def _mirrors_by_latency(self) -> List[str]:
+        # Mirrors which were not measured yet come after the measured ones, they
+        # are measured when the faster ones are slow to answer or fail.
+        urls = [self.helm_repo_url, *self.mirror_urls]
+        return sorted(urls, key=lambda url: self._latency.get(url, float("inf")))
+
+    def _get_index_response(self, reusable: bool) -> Tuple[str, requests.Response]:
+        urls = self._mirrors_by_latency()
+        if len(urls) == 1:
+            return urls[0], self._get_index(urls[0], reusable)
+
+        # Hedged requests: the next mirror is asked whenever the previous ones
+        # did not answer within hedge_delay or failed, the first answer wins.
+        if self._hedge_executor is None:
+            self._hedge_executor = ThreadPoolExecutor(max_workers=len(urls))
+        pending = {}
+        error = None
+        while urls or pending:
+            if urls:
+                url = urls.pop(0)
+                future = self._hedge_executor.submit(self._get_index, url, reusable)
+                pending[future] = (url, time.monotonic())
+            done, _ = wait(
+                pending,
+                timeout=self.hedge_delay if urls else None,
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                url, _ = pending.pop(future)
+                try:
+                    response = future.result()
+                except RequestException as e:
+                    log.info(f"Chart list mirror {url} failed: {str(e)}")
+                    error = e
+                    continue
+                for other, (other_url, start) in pending.items():
+                    # Slower mirrors are at least as slow as the time waited so far
+                    self._record_latency(other_url, time.monotonic() - start)
+                    other.add_done_callback(close_response)
+                log.debug(f"Chart list served by {url}")
+                return url, response
+        raise error
+
+    def _parse_index(
+        self,
+        body: IO[bytes],
+        content_type: str = "",
+        chart_names: Optional[AbstractSet[str]] = None,
+    ) -> dict:
+        try:
+            start = body.read(INDEX_CHUNK_SIZE).lstrip()
+            body.seek(0)
+            if (
+                "json" in content_type
+                or self.index_path.endswith(".json")
+                or start[:1] == b"{"
+            ):
+                return json.load(body)
+            if chart_names is not None:
+                selected = select_index_entries(body, chart_names)
+                if selected is not None:
+                    return yaml.load(selected, Loader=YamlLoader) or {}
+                log.debug("Unknown chart list layout, parsing all charts")
+                body.seek(0)
+            return yaml.load(body, Loader=YamlLoader)
+        except (ValueError, yaml.YAMLError) as e:
+            raise UpdateException(f"Cannot parse chart list: {str(e)}")
+
+    def _get_latest_chart(
+        self, chart_name: str, chart_version_pattern: str
+    ) -> Optional[ChartVersion]:
+        pattern = compile_version_pattern(chart_version_pattern)
+        for chart in (self._catalog or {}).get(chart_name, []):
+            if pattern.match(chart.version, chart.semver):
+                return chart
+        log.info(
+            f"No chart {chart_name} matching {chart_version_pattern} found in the Helm repository"
+        )
+        return None
+
+
+class ChartMuseumRepo(HelmRepo):
+    # Downloads only the charts referenced by manifests from ChartMuseum's
+    # per-chart API, concurrently and each with its own conditional request.
+    # The monolithic index is used only when the referenced charts are unknown.
+
+    def __init__(self, helm_repo_url: str, *args, max_workers: int = 8, **kwargs):
+        self.max_workers = max_workers
+        self._chart_validators = {}
+        super().__init__(helm_repo_url, *args, **kwargs)
+
+    def _cache_key(self) -> str:
+        return f"{self.helm_repo_url}/api/charts"
+
+    def _restore_cache_state(self, cache: dict) -> None:
+        super()._restore_cache_state(cache)
+        self._chart_validators = cache.get("chart_validators", {})
+
+    def _cache_state(self) -> dict:
+        return {**super()._cache_state(), "chart_validators": self._chart_validators}
+
+    def update(self, chart_names: Optional[Iterable[str]] = None) -> Optional[Set[str]]:
+        if chart_names is None:
+            self._chart_validators = {}
+            return super().update()
+        chart_names = sorted(set(chart_names))
+        if not chart_names:
+            return set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(self._load_chart_versions, chart_names))
+
+        catalog = dict(self._catalog or {})
+        for chart_name, chart_versions in zip(chart_names, results):
+            if chart_versions is not None:
+                catalog[chart_name] = chart_versions
+        delta = self._catalog_delta(self._catalog, catalog)
+        if delta is not None and not delta:
+            log.debug("Charts not modified")
+            return delta
+        self._catalog = catalog
+        loaded_charts = frozenset(catalog)
+        if self._loaded_charts is not None:
+            loaded_charts = loaded_charts | self._loaded_charts
+        self._loaded_charts = loaded_charts
+        self._resolved = {}
+        if self._cache_path:
+            self._save_cache()
+        return delta
+
+    def _load_chart_versions(self, chart_name: str) -> Optional[List[ChartVersion]]:
+        headers = {"Accept": "application/json"}
+        if self._catalog is not None and chart_name in self._catalog:
+            headers.update(
+                conditional_headers(
+                    *self._chart_validators.get(chart_name, (None, None))
+                )
+            )
         try:
-            (type_, value) = pattern.split(":")
-        except ValueError:
-            type_, value = None, None
-
-        if type_ == "glob":
-            return fnmatch.fnmatch(version, value)
-        elif type_ == "regexp" or type_ == "regex":
-            return re.search(value, version) is not None
-        elif type_ == "semver":
-            matcher = semantic_version.NpmSpec(value)
-            return matcher.match(semantic_version.Version(version))
-        else:
-            raise UpdateException("Invalid chart version pattern: {pattern}")
+            response = self._session.get(
+                f"{self.helm_repo_url}/api/charts/{quote(chart_name, safe='')}",
+                headers=headers,
+                timeout=self._timeout,
+            )
+            if response.status_code == 304:
+                return None
+            if response.status_code == 404:
+                entries = []
+            else:
+                response.raise_for_status()
+                entries = response.json()
+        except (RequestException, ValueError) as e:
+            raise UpdateException(f"Cannot download chart {chart_name}: {str(e)}")
+        self._chart_validators[chart_name] = (
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+        )
+        return self._build_chart_versions(entries)
@@ -1,12 +1,14 @@
 import logging
-from typing import Optional
+from typing import Dict, Iterator, Optional, Tuple
 
 # We use ruamel library for YAML manipulation because it preserves format, comments, etc.
-# But it is slower than PyYAML for large documents.
+# But it is slower than PyYAML for large documents, which is used when the manifest
+# is only read.
+import yaml as safe_yaml
 from ruamel import yaml
 
 from . import UpdateException
-from .helm_repo import HelmRepo
+from .helm_repo import HelmRepo, YamlLoader
 
 CHART_AUTO_UPDATE = "chart-auto-update"
 CHART_VERSION_PATTERN = "chart-version"
@@ -24,6 +26,55 @@ def is_true_value(value: str) -> bool:
     return str(value).lower() == "true"
 
 
+def _find_node(node, keys: Tuple[str, ...]):
+    for key in keys:
+        if not isinstance(node, safe_yaml.MappingNode):
+            return None
+        node = next((v for k, v in node.value if k.value == key), None)
+    return node
+
+
+def _format_scalar(value: str, style: Optional[str]) -> str:
+    if style == "'":
+        return "'" + value.replace("'", "''") + "'"
+    if not style and safe_yaml.load(value, Loader=YamlLoader) == value:
+        return value
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def patch_scalars(text: str, edits: Dict[Tuple[str, ...], str]) -> Optional[str]:
+    # Replaces single-line scalars in place, keeping their quoting and everything
+    # around them. Returns None when some scalar cannot be patched this way.
+    root = safe_yaml.compose(text, Loader=YamlLoader)
+    lines = text.splitlines(keepends=True)
+    replacements = []
+    for keys, value in edits.items():
+        node = _find_node(root, keys)
+        if (
+            not isinstance(node, safe_yaml.ScalarNode)
+            or node.style not in (None, "", "'", '"')
+            or node.start_mark.line != node.end_mark.line
+        ):
+            return None
+        replacements.append(
+            (
+                node.start_mark.line,
+                node.start_mark.column,
+                node.end_mark.column,
+                _format_scalar(value, node.style),
+            )
+        )
+    for line, start, end, replacement in sorted(replacements, reverse=True):
+        lines[line] = lines[line][:start] + replacement + lines[line][end:]
+    return "".join(lines)
+
+
+def _set_value(manifest, keys: Tuple[str, ...], value: str) -> None:
+    for key in keys[:-1]:
+        manifest = manifest[key]
+    manifest[keys[-1]] = value
+
+
 class HelmRelease:
     @staticmethod
     def load(manifest):
@@ -87,22 +138,86 @@ class HelmReleaseV2(HelmRelease):
     def chart_version(self, version):
         self.manifest["spec"]["chart"]["spec"]["version"] = version
 
+    @property
+    def source_ref(self):
+        source_ref = self.manifest["spec"]["chart"]["spec"].get("sourceRef") or {}
+        namespace = source_ref.get("namespace") or self.manifest.get(
+            "metadata", {}
+        ).get("namespace")
+        return namespace, source_ref.get("name")
+
+
+class ManifestSummary:
+    # Everything needed to decide whether a manifest has to be updated
+    __slots__ = (
+        "chart_name",
+        "chart_version",
+        "chart_version_pattern",
+        "source_ref",
+        "image_tags",
+    )
+
+    def __init__(
+        self,
+        chart_name: str,
+        chart_version,
+        chart_version_pattern: str,
+        source_ref: Tuple[Optional[str], Optional[str]],
+        image_tags: Dict[str, Optional[str]],
+    ):
+        self.chart_name = chart_name
+        self.chart_version = chart_version
+        self.chart_version_pattern = chart_version_pattern
+        self.source_ref = source_ref
+        self.image_tags = image_tags
+
+    def needs_update(self, helm_repo: HelmRepo) -> bool:
+        (
+            latest_chart_version,
+            latest_chart_app_version,
+        ) = helm_repo.get_latest_chart_versions(
+            self.chart_name, self.chart_version_pattern
+        )
+        if latest_chart_version is not None:
+            if latest_chart_version != self.chart_version:
+                return True
+        if latest_chart_app_version is not None:
+            return any(
+                tag != latest_chart_app_version for tag in self.image_tags.values()
+            )
+        return False
+
 
 class Manifest:
     def __init__(self, annotation_prefix: str = "rossum.ai"):
         self.annotation_prefix = annotation_prefix
+        self._edits = {}
         self._chart_auto_update_key = f"{annotation_prefix}/{CHART_AUTO_UPDATE}"
         self._chart_version_pattern_key = f"{annotation_prefix}/{CHART_VERSION_PATTERN}"
         self._chart_version_updated = False
         self._chart_image_updated = False
 
-    def load(self, path: str) -> None:
+    def load(self, path: str, round_trip: bool = True) -> None:
+        try:
+            with open(path, "r", newline="") as f:
+                text = f.read()
+        except Exception as e:
+            raise UpdateException(f"Cannot load manifest {path}: {str(e)}")
+        self.loads(text, round_trip, path)
+
+    def loads(self, text: str, round_trip: bool = True, path: str = "") -> None:
+        # Manifests loaded without round_trip are saved by patching changed
+        # scalars in the original text.
         try:
-            with open(path, "r") as f:
-                manifest = yaml.round_trip_load(f, preserve_quotes=True)
+            if round_trip:
+                manifest = yaml.round_trip_load(text, preserve_quotes=True)
+            else:
+                manifest = safe_yaml.load(text, Loader=YamlLoader)
         except Exception as e:
             raise UpdateException(f"Cannot load manifest {path}: {str(e)}")
 
+        self._round_trip = round_trip
+        self._text = None if round_trip else text
         try:
             self._helmrelease = HelmRelease.load(manifest)
         except InvalidManifestError as e:
@@ -110,11 +225,33 @@ class Manifest:
 
     def save(self, path: str) -> None:
         try:
-            with open(path, "w") as f:
-                yaml.round_trip_dump(self._helmrelease.manifest, f)
+            text = self.dump()
+            with open(path, "w", newline="") as f:
+                f.write(text)
         except Exception as e:
             raise UpdateException(f"Cannot update manifest {path}: {str(e)}")
 
+    def dump(self) -> str:
+        try:
+            if self._round_trip:
+                return yaml.round_trip_dump(self._helmrelease.manifest)
+            return self._patched_text()
+        except Exception as e:
+            raise UpdateException(f"Cannot serialize manifest: {str(e)}")
+
+    def _patched_text(self) -> str:
+        text = patch_scalars(self._text, self._edits)
+        if (
+            text is not None
+            and safe_yaml.load(text, Loader=YamlLoader) == self._helmrelease.manifest
+        ):
+            return text
+        log.info("Cannot patch manifest in place, serializing it again")
+        manifest = yaml.round_trip_load(self._text, preserve_quotes=True)
+        for keys, value in self._edits.items():
+            _set_value(manifest, keys, value)
+        return yaml.round_trip_dump(manifest)
+
     @property
     def chart_name(self) -> Optional[str]:
         return self._helmrelease.chart_name
@@ -127,6 +264,10 @@ class Manifest:
     def image_tag(self) -> Optional[str]:
         return self._helmrelease.image_tag
 
+    @property
+    def source_ref(self) -> Tuple[Optional[str], Optional[str]]:
+        return self._helmrelease.source_ref
+
     @property
     def chart_version_pattern(self) -> Optional[str]:
         return self._helmrelease.annotations[self._chart_version_pattern_key]
@@ -144,6 +285,7 @@ class Manifest:
             return False
 
         self._helmrelease.chart_version = new_version
+        self._edits[("spec", "chart", "spec", "version")] = new_version
 
         log.info(
             f"Updating chart {self.chart_name} from {self.chart_version} to {new_version}"
@@ -156,42 +298,80 @@ class Manifest:
 
         return self.chart_version != new_version
 
+    def _enabled_image_names(self) -> Iterator[str]:
+        annotation_prefix = f"{self.annotation_prefix}/{IMAGE_PREFIX}"
+        for key, value in self._helmrelease.annotations.items():
+            if not is_true_value(value):
+                continue
+            if key.startswith(annotation_prefix):
+                yield key[len(annotation_prefix) :]
+
+    @staticmethod
+    def _image_keys(image_name: str) -> Tuple[str, ...]:
+        if image_name == DEFAULT_CHART_IMAGE:
+            return ("spec", "values", "image")
+        return ("spec", "values", image_name, "image")
+
+    def _image_values(self, image_name: str):
+        if image_name == DEFAULT_CHART_IMAGE:
+            return self._helmrelease.values["image"]
+        return self._helmrelease.values[image_name]["image"]
+
     def _update_image(self, new_tag: Optional[str]) -> bool:
         if new_tag is None:
             return False
 
         updated = False
-        annotation_prefix = f"{self.annotation_prefix}/{IMAGE_PREFIX}"
-        for key, value in self._helmrelease.annotations.items():
-            if not is_true_value(value):
+        for image_name in self._enabled_image_names():
+            image = self._image_values(image_name)
+            old_tag = image["tag"]
+            if old_tag == new_tag:
                 continue
-            if key.startswith(annotation_prefix):
-                image_name = key[len(annotation_prefix) :]
-                if image_name == DEFAULT_CHART_IMAGE:
-                    image = self._helmrelease.values["image"]
-                else:
-                    image = self._helmrelease.values[image_name]["image"]
-                old_tag = image["tag"]
-                if old_tag == new_tag:
-                    continue
-                image["tag"] = new_tag
-                updated = True
-                log.info(
-                    f"Updating image {self.chart_name}:{image_name} from {old_tag} to {new_tag}"
-                )
+            image["tag"] = new_tag
+            self._edits[(*self._image_keys(image_name), "tag")] = new_tag
+            updated = True
+            log.info(
+                f"Updating image {self.chart_name}:{image_name} from {old_tag} to {new_tag}"
+            )
         return updated
 
+    def summary(self) -> ManifestSummary:
+        image_tags = {}
+        for image_name in self._enabled_image_names():
+            try:
+                image_tags[image_name] = self._image_values(image_name).get("tag")
+            except (AttributeError, KeyError, TypeError):
+                image_tags[image_name] = None
+        return ManifestSummary(
+            self.chart_name,
+            self.chart_version,
+            self.chart_version_pattern,
+            self.source_ref,
+            image_tags,
+        )
+
+    @property
+    def auto_updates_enabled(self) -> bool:
+        return self._auto_updates_enabled(self._helmrelease)
+
     def update_with_latest_chart(self, helm_repo: HelmRepo) -> bool:
-        if not self._auto_updates_enabled(self._helmrelease):
+        if not self.auto_updates_enabled:
             return False
 
-        (
-            latest_chart_version,
-            latest_chart_app_version,
-        ) = helm_repo.get_latest_chart_versions(
-            self.chart_name, self.chart_version_pattern
+        return self.update_with_versions(
+            *helm_repo.get_latest_chart_versions(
+                self.chart_name, self.chart_version_pattern
+            )
         )
 
+    def update_with_versions(
+        self,
+        latest_chart_version: Optional[str],
+        latest_chart_app_version: Optional[str],
+    ) -> bool:
+        if not self.auto_updates_enabled:
+            return False
+
         self._chart_updated = self._update_chart(latest_chart_version)
         self._image_updated = self._update_image(latest_chart_app_version)
         return self._chart_updated or self._image_updated
@@ -1,32 +1,81 @@
 import logging
+import multiprocessing
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from threading import Event, Thread
 from time import sleep
-from typing import Iterator, Optional
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
 
 from . import UpdateException
-from .git import Git
+from .git import GitBackend
 from .helm_repo import HelmRepo
-from .manifest import Manifest
+from .manifest import Manifest, ManifestSummary
 
 log = logging.getLogger("chart-updater")
 
 
+# Manifests are parsed by these functions, possibly in worker processes, so they
+# only take and return picklable values.
+
+
+def summarize_manifest(
+    path: str, text: str, annotation_prefix: str
+) -> Optional[ManifestSummary]:
+    manifest = Manifest(annotation_prefix)
+    manifest.loads(text, round_trip=False, path=path)
+    if not manifest.auto_updates_enabled:
+        return None
+    return manifest.summary()
+
+
+def plan_manifest_update(
+    path: str,
+    text: str,
+    annotation_prefix: str,
+    write_mode: str,
+    latest_versions: Tuple[Optional[str], Optional[str]],
+) -> Optional[Tuple[str, str]]:
+    # Returns the updated manifest text and its commit message
+    manifest = Manifest(annotation_prefix)
+    # "patch" mode rewrites only the changed scalars of the original text
+    manifest.loads(text, round_trip=write_mode != "patch", path=path)
+    if not manifest.update_with_versions(*latest_versions):
+        return None
+    return manifest.dump(), Updater._build_commit_message(manifest)
+
+
 class Updater:
     def __init__(
         self,
-        git: Git,
-        helm_repo: HelmRepo,
+        git: GitBackend,
+        helm_repo: Optional[HelmRepo],
         refresh_period: int = 60,
         annotation_prefix: str = "rossum.ai",
         event: Optional[Event] = None,
+        helm_repos: Optional[Dict[str, HelmRepo]] = None,
+        rescan_event: Optional[Event] = None,
+        write_mode: str = "roundtrip",
+        manifest_workers: int = 1,
+        batch_commits: bool = False,
     ) -> None:
         self.git = git
         self.helm_repo = helm_repo
+        self.helm_repos = helm_repos or {}
         self.annotation_prefix = annotation_prefix
         self.refresh_period = refresh_period
         self._event = event
         self._cloned = False
+        self._rescan_event = rescan_event
+        self._scanned_head = None
+        self._candidates = set()
+        self._chart_manifests = {}
+        self._stale_helm_repos = set()
+        self._summaries = {}
+        self._summary_blobs = {}
+        self.write_mode = write_mode
+        self.manifest_workers = manifest_workers
+        self._manifest_pool = None
+        self.batch_commits = batch_commits
 
     def start(self) -> None:
         Thread(target=self.update_loop, daemon=True).start()
@@ -41,36 +90,314 @@ class Updater:
             parts.append(f"image {manifest.image_tag}")
         return f"Release of {chart_name} {', '.join(parts)}"
 
-    def _manifests_to_check(self) -> Iterator[str]:
-        helmreleases = self.git.grep("HelmRelease")
-        manifests_with_annotation = self.git.grep(self.annotation_prefix + "/")
-        return iter(set(helmreleases).intersection(manifests_with_annotation))
+    @staticmethod
+    def _build_batch_commit_message(commit_messages: List[str]) -> str:
+        if len(commit_messages) == 1:
+            return commit_messages[0]
+        releases = "\n".join(f"- {message}" for message in commit_messages)
+        return f"Release of {len(commit_messages)} manifests\n\n{releases}"
+
+    def _manifests_to_check(self, pathspecs: Optional[List[str]] = None) -> List[str]:
+        return self.git.grep(["HelmRelease", self.annotation_prefix + "/"], pathspecs)
+
+    def _load_manifests(
+        self, paths: Iterable[str]
+    ) -> List[Tuple[str, ManifestSummary]]:
+        # Manifests are only parsed when their blob is not known yet
+        paths = list(paths)
+        blob_ids = self.git.blob_ids(paths)
+        texts = self.git.read_files(
+            [path for path in paths if blob_ids.get(path) not in self._summaries]
+        )
+        unknown = list(texts)
+        summaries = self._evaluate(
+            summarize_manifest,
+            [(path, texts[path], self.annotation_prefix) for path in unknown],
+        )
+        for path, summary in zip(unknown, summaries):
+            if path in blob_ids:
+                self._summaries[blob_ids[path]] = summary
+        for path, blob_id in blob_ids.items():
+            if blob_id in self._summaries:
+                self._summary_blobs[path] = blob_id
+        summaries = dict(zip(unknown, summaries))
+        manifests = []
+        for path in paths:
+            if path in summaries:
+                summary = summaries[path]
+            else:
+                summary = self._summaries.get(blob_ids.get(path))
+            if summary is not None:
+                manifests.append((path, summary))
+        return manifests
+
+    def _get_manifest_pool(self) -> ProcessPoolExecutor:
+        # Workers are spawned rather than forked, the main process runs threads
+        if self._manifest_pool is None:
+            self._manifest_pool = ProcessPoolExecutor(
+                self.manifest_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._manifest_pool
 
-    def _update_manifest(self, path: str) -> bool:
+    @staticmethod
+    def _call(function: Callable, *args):
         try:
-            manifest = Manifest(self.annotation_prefix)
-            manifest.load(path)
-            if not manifest.update_with_latest_chart(self.helm_repo):
-                return False
-            manifest.save(path)
-            commit_message = self._build_commit_message(manifest)
-            self.git.update_file(path, commit_message)
-            return True
+            return function(*args)
         except UpdateException as e:
             log.info(str(e))
+            return None
+
+    def _evaluate(self, function: Callable, calls: List[tuple]) -> List:
+        # Results are returned in the order of calls, failed calls give None
+        if self.manifest_workers <= 1 or len(calls) <= 1:
+            return [self._call(function, *args) for args in calls]
+        pool = self._get_manifest_pool()
+        futures = [pool.submit(function, *args) for args in calls]
+        return [self._call(future.result) for future in futures]
+
+    def _prune_summaries(self) -> None:
+        blob_ids = self.git.blob_ids(sorted(self._candidates))
+        known = set(blob_ids.values())
+        self._summaries = {
+            blob_id: summary
+            for blob_id, summary in self._summaries.items()
+            if blob_id in known
+        }
+        self._summary_blobs = {
+            path: blob_id
+            for path, blob_id in blob_ids.items()
+            if blob_id in self._summaries
+        }
+
+    def _forget_summaries(self, paths: Set[str]) -> None:
+        # Summaries of replaced blobs are dropped unless another path shares them
+        replaced = {
+            self._summary_blobs.pop(path)
+            for path in paths
+            if path in self._summary_blobs
+        }
+        for blob_id in replaced - set(self._summary_blobs.values()):
+            del self._summaries[blob_id]
+
+    def _helm_repo_for(self, manifest: ManifestSummary) -> Optional[HelmRepo]:
+        namespace, name = manifest.source_ref
+        for key in (f"{namespace}/{name}", name):
+            if key in self.helm_repos:
+                return self.helm_repos[key]
+        return self.helm_repo
+
+    def _with_helm_repos(
+        self, manifests: List[Tuple[str, ManifestSummary]]
+    ) -> List[Tuple[str, ManifestSummary, HelmRepo]]:
+        resolvable = []
+        for path, manifest in manifests:
+            helm_repo = self._helm_repo_for(manifest)
+            if helm_repo is None:
+                log.info(f"No Helm repository configured for manifest {path}")
+                continue
+            resolvable.append((path, manifest, helm_repo))
+        return resolvable
+
+    def _update_helm_repos(
+        self, charts: Dict[HelmRepo, Set[str]]
+    ) -> Dict[HelmRepo, Optional[Set[str]]]:
+        # Returns changed charts of successfully updated repositories
+        if not charts:
+            return {}
+        with ThreadPoolExecutor(max_workers=len(charts)) as executor:
+            futures = {
+                helm_repo: executor.submit(helm_repo.update, chart_names)
+                for helm_repo, chart_names in charts.items()
+            }
+        deltas = {}
+        for helm_repo, future in futures.items():
+            try:
+                deltas[helm_repo] = future.result()
+            except UpdateException as e:
+                log.error(f"{helm_repo.helm_repo_url}: {str(e)}")
+        return deltas
+
+    def _index_manifests(self, manifests: List[Tuple[str, ManifestSummary, HelmRepo]]):
+        for path, manifest, helm_repo in manifests:
+            charts = self._chart_manifests.setdefault(helm_repo, {})
+            charts.setdefault(manifest.chart_name, set()).add(path)
+
+    def _forget_manifests(self, paths: Set[str]) -> None:
+        for helm_repo, charts in list(self._chart_manifests.items()):
+            for chart_name, chart_paths in list(charts.items()):
+                chart_paths -= paths
+                if not chart_paths:
+                    del charts[chart_name]
+            if not charts:
+                del self._chart_manifests[helm_repo]
+
+    def _update_referenced_helm_repos(self) -> Dict[HelmRepo, Optional[Set[str]]]:
+        deltas = self._update_helm_repos(
+            {
+                helm_repo: set(charts)
+                for helm_repo, charts in self._chart_manifests.items()
+            }
+        )
+        # Manifests of repositories which failed are checked again once they recover
+        for helm_repo in self._stale_helm_repos & deltas.keys():
+            deltas[helm_repo] = None
+        self._stale_helm_repos = self._chart_manifests.keys() - deltas.keys()
+        return deltas
+
+    def _needs_full_scan(self, head: str) -> bool:
+        if self._rescan_event and self._rescan_event.is_set():
+            self._rescan_event.clear()
+            log.info("Rescan of all manifests requested")
+            return True
+        if self._scanned_head is None:
+            return True
+        if head == self._scanned_head:
+            return False
+        if not self.git.is_ancestor(self._scanned_head, head):
+            log.info("Branch history was rewritten, rescanning all manifests")
+            return True
+        return False
+
+    def _scan_all_manifests(self) -> List[Tuple[str, ManifestSummary, HelmRepo]]:
+        paths = self._manifests_to_check()
+        self._candidates = set(paths)
+        self._prune_summaries()
+        manifests = self._with_helm_repos(self._load_manifests(paths))
+        self._chart_manifests = {}
+        self._index_manifests(manifests)
+        deltas = self._update_referenced_helm_repos()
+        return [item for item in manifests if item[2] in deltas]
+
+    def _scan_changed_manifests(
+        self, head: str, deltas: Optional[Dict[HelmRepo, Optional[Set[str]]]] = None
+    ) -> List[Tuple[str, ManifestSummary, HelmRepo]]:
+        changed = set()
+        if head != self._scanned_head:
+            changed = set(self.git.changed_files(self._scanned_head, head))
+        if changed:
+            self._forget_summaries(changed)
+            self._candidates -= changed
+            self._candidates.update(self._manifests_to_check(sorted(changed)))
+        manifests = self._with_helm_repos(
+            self._load_manifests(sorted(changed & self._candidates))
+        )
+        self._forget_manifests(changed)
+        self._index_manifests(manifests)
+
+        # Unchanged manifests only need to be checked if their chart changed
+        paths = set()
+        if deltas is None:
+            deltas = self._update_referenced_helm_repos()
+        for helm_repo, delta in deltas.items():
+            charts = self._chart_manifests[helm_repo]
+            for chart_name in charts if delta is None else delta & charts.keys():
+                paths.update(charts[chart_name])
+        paths -= changed
+        log.info(
+            f"Checking {len(manifests)} changed manifests "
+            f"and {len(paths)} manifests of updated charts"
+        )
+        manifests += self._with_helm_repos(self._load_manifests(sorted(paths)))
+        return sorted(
+            (item for item in manifests if item[2] in deltas), key=lambda item: item[0]
+        )
+
+    def _update_manifests(
+        self, manifests: List[Tuple[str, ManifestSummary, HelmRepo]]
+    ) -> Tuple[bool, bool]:
+        # Updates are planned concurrently, but written and committed in the
+        # order of the manifests. Returns whether anything was committed and
+        # whether all planned updates were.
+        updates = {}
+        for path, summary, helm_repo in manifests:
+            # A manifest whose versions cannot be resolved is skipped on its own
+            try:
+                if summary.needs_update(helm_repo):
+                    updates[path] = helm_repo.get_latest_chart_versions(
+                        summary.chart_name, summary.chart_version_pattern
+                    )
+            except UpdateException as e:
+                log.info(f"Cannot update manifest {path}: {str(e)}")
+        texts = self.git.read_files(list(updates))
+        calls = [
+            (path, texts[path], self.annotation_prefix, self.write_mode, versions)
+            for path, versions in updates.items()
+            if path in texts
+        ]
+        plans = self._evaluate(plan_manifest_update, calls)
+        written = {}
+        complete = True
+        for (path, *_), plan in zip(calls, plans):
+            if plan is None:
+                continue
+            text, commit_message = plan
+            if self.batch_commits:
+                written[path] = text, commit_message
+                continue
+            try:
+                self.git.commit_files({path: text}, commit_message)
+            except UpdateException as e:
+                log.info(str(e))
+                complete = False
+                continue
+            written[path] = text, commit_message
+        if self.batch_commits and written:
+            self.git.commit_files(
+                {path: text for path, (text, _) in written.items()},
+                self._build_batch_commit_message(
+                    [commit_message for _, commit_message in written.values()]
+                ),
+            )
+        return bool(written), complete
+
+    def _remote_unchanged(self) -> bool:
+        if self._scanned_head is None:
             return False
+        if self._rescan_event and self._rescan_event.is_set():
+            return False
+        return self.git.remote_head() == self._scanned_head
 
     def _one_update_iteration(self) -> None:
+        # Helm repositories report changed charts only once, so an iteration
+        # which did not commit all its updates makes the next one rescan all
+        # manifests.
+        try:
+            complete = self._check_for_updates()
+        except Exception:
+            self._scanned_head = None
+            raise
+        if not complete:
+            self._scanned_head = None
+
+    def _check_for_updates(self) -> bool:
         log.info("Checking for chart updates")
-        self.git.update_branch()
-        self.helm_repo.update()
+        if self._remote_unchanged():
+            # The checkout is up to date, so only the Helm repositories are checked
+            deltas = self._update_referenced_helm_repos()
+            if all(delta == set() for delta in deltas.values()):
+                log.info("No changes in git or Helm repositories, nothing to do")
+                return True
+            manifests = self._scan_changed_manifests(self._scanned_head, deltas)
+        else:
+            self.git.update_branch()
+            # Only manifests changed since the last scanned commit and manifests of
+            # charts with new versions are checked, unless a full scan is needed.
+            head = self.git.head()
+            if self._needs_full_scan(head):
+                manifests = self._scan_all_manifests()
+            else:
+                manifests = self._scan_changed_manifests(head)
 
-        updated = [self._update_manifest(path) for path in self._manifests_to_check()]
-        if any(updated):
+        updated, complete = self._update_manifests(manifests)
+        if updated:
+            # Local commits are dropped when the push fails, rescan everything then
+            self._scanned_head = None
             self.git.push_to_branch()
             log.info("Update finished")
         else:
             log.info("No updates detected")
+        self._scanned_head = self.git.head()
+        return complete
 
     def _ensure_git_repo_cloned(self):
         if self._cloned:
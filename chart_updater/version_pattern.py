@@ -0,0 +1,57 @@
+import fnmatch
+import re
+from functools import lru_cache
+from typing import Optional
+
+import semantic_version
+
+from chart_updater import UpdateException
+
+
+@lru_cache(maxsize=4096)
+def parse_semver(version: str) -> Optional[semantic_version.Version]:
+    try:
+        return semantic_version.Version(version)
+    except ValueError:
+        return None
+
+
+class VersionPattern:
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        try:
+            (type_, value) = pattern.split(":", 1)
+            if type_ == "glob":
+                self._regex = re.compile(fnmatch.translate(value))
+                self._match = self._match_glob
+            elif type_ == "regexp" or type_ == "regex":
+                self._regex = re.compile(value)
+                self._match = self._match_regex
+            elif type_ == "semver":
+                self._spec = semantic_version.NpmSpec(value)
+                self._match = self._match_semver
+            else:
+                raise ValueError(f"unknown pattern type {type_}")
+        except (ValueError, re.error) as e:
+            raise UpdateException(f"Invalid chart version pattern {pattern}: {str(e)}")
+
+    def _match_glob(self, version: str, parsed: Optional[semantic_version.Version]):
+        return self._regex.match(version) is not None
+
+    def _match_regex(self, version: str, parsed: Optional[semantic_version.Version]):
+        return self._regex.search(version) is not None
+
+    def _match_semver(self, version: str, parsed: Optional[semantic_version.Version]):
+        if parsed is None:
+            parsed = parse_semver(version)
+        return parsed is not None and self._spec.match(parsed)
+
+    def match(
+        self, version: str, parsed: Optional[semantic_version.Version] = None
+    ) -> bool:
+        return self._match(version, parsed)
+
+
+@lru_cache(maxsize=1024)
+def compile_version_pattern(pattern: str) -> VersionPattern:
+    return VersionPattern(pattern)
@@ -1,9 +1,16 @@
 import re
 from os import mkdir
 from subprocess import PIPE, run
+from typing import List
+from unittest.mock import Mock, patch
 
+import pytest
+
+from chart_updater import UpdateException
+from chart_updater.dulwich_git import DulwichGit, Repo
 from chart_updater.git import Git
 from chart_updater.helm_repo import HelmRepo
+from chart_updater.manifest import Manifest
 from chart_updater.updater import Updater
 
 MANIFEST_PATH = "helmrelease.yaml"
@@ -513,6 +520,340 @@ def test_chart_updated_flux2(empty_git_repo, requests_mock):
     assert re.search(CHART_RELEASE_COMMIT_RE, _last_commit())
 
 
+def test_chart_updated_flux2_selective(empty_git_repo, requests_mock):
+    _add_manifest(MANIFEST_WITH_FLUX2)
+    _init_commit()
+    requests_mock.get(HELM_REPO_INDEX, text=CHART_REPO_INDEX_WITH_NEW_CHARTS)
+
+    updater = Updater(Git(empty_git_repo), HelmRepo(HELM_REPO_URL, selective=True))
+    updater.update_loop(one_shot=True)
+
+    assert _get_manifest() == UPDATED_MANIFEST_WITH_FLUX2
+    assert re.search(CHART_RELEASE_COMMIT_RE, _last_commit())
+
+
+def test_chart_updated_flux2_patch_mode(empty_git_repo, requests_mock):
+    _add_manifest(MANIFEST_WITH_FLUX2)
+    _init_commit()
+    requests_mock.get(HELM_REPO_INDEX, text=CHART_REPO_INDEX_WITH_NEW_CHARTS)
+
+    updater = Updater(Git(empty_git_repo), HelmRepo(HELM_REPO_URL), write_mode="patch")
+    updater.update_loop(one_shot=True)
+
+    assert _get_manifest() == UPDATED_MANIFEST_WITH_FLUX2
+    assert re.search(CHART_RELEASE_COMMIT_RE, _last_commit())
+
+
+def test_manifests_updated_in_worker_processes(empty_git_repo, requests_mock):
+    mkdir("deploy")
+    paths = [f"deploy/{i}-helmrelease.yaml" for i in range(3)]
+    for path in paths:
+        _add_manifest(MANIFEST_WITH_FLUX2, path=path)
+    _init_commit()
+    requests_mock.get(HELM_REPO_INDEX, text=CHART_REPO_INDEX_WITH_NEW_CHARTS)
+
+    updater = Updater(Git(empty_git_repo), HelmRepo(HELM_REPO_URL), manifest_workers=2)
+    updater.update_loop(one_shot=True)
+    updater._manifest_pool.shutdown()
+
+    for path in paths:
+        assert _get_manifest(path) == UPDATED_MANIFEST_WITH_FLUX2
+    log = run(
+        ["git", "log", "--format=", "--name-only", "-3"],
+        stdout=PIPE,
+        text=True,
+        check=True,
+    ).stdout
+    assert log.split() == paths[::-1]
+
+
+def test_updated_manifests_committed_together(empty_git_repo, requests_mock):
+    mkdir("deploy")
+    paths = ["deploy/1-helmrelease.yaml", "deploy/2-helmrelease.yaml"]
+    for path in paths:
+        _add_manifest(MANIFEST_WITH_FLUX2, path=path)
+    _init_commit()
+    requests_mock.get(HELM_REPO_INDEX, text=CHART_REPO_INDEX_WITH_NEW_CHARTS)
+
+    updater = Updater(Git(empty_git_repo), HelmRepo(HELM_REPO_URL), batch_commits=True)
+    updater.update_loop(one_shot=True)
+
+    for path in paths:
+        assert _get_manifest(path) == UPDATED_MANIFEST_WITH_FLUX2
+    commit = _last_commit()
+    assert "Release of 2 manifests" in commit
+    assert commit.count("- Release of hello-world 1.2.4") == 2
+    assert (
+        "Init"
+        in run(
+            ["git", "log", "--format=%s", "-1", "HEAD~"], stdout=PIPE, text=True
+        ).stdout
+    )
+
+
+def test_manifest_with_invalid_pattern_skipped(empty_git_repo, requests_mock):
+    invalid_manifest = MANIFEST_WITH_FLUX2.replace("glob:1.2.*", "1.2.*")
+    mkdir("deploy")
+    _add_manifest(invalid_manifest, path="deploy/1-helmrelease.yaml")
+    _add_manifest(MANIFEST_WITH_FLUX2, path="deploy/2-helmrelease.yaml")
+    _init_commit()
+    requests_mock.get(HELM_REPO_INDEX, text=CHART_REPO_INDEX_WITH_NEW_CHARTS)
+
+    updater = Updater(Git(empty_git_repo), HelmRepo(HELM_REPO_URL))
+    updater.update_loop(one_shot=True)
+
+    assert _get_manifest("deploy/1-helmrelease.yaml") == invalid_manifest
+    assert _get_manifest("deploy/2-helmrelease.yaml") == UPDATED_MANIFEST_WITH_FLUX2
+
+
+def test_manifest_with_invalid_encoding_skipped(empty_git_repo, requests_mock):
+    mkdir("deploy")
+    with open("deploy/1-helmrelease.yaml", "wb") as f:
+        f.write(MANIFEST_WITH_FLUX2.encode() + "# caf\xe9\n".encode("latin-1"))
+    run(["git", "add", "deploy/1-helmrelease.yaml"])
+    _add_manifest(MANIFEST_WITH_FLUX2, path="deploy/2-helmrelease.yaml")
+    _init_commit()
+    requests_mock.get(HELM_REPO_INDEX, text=CHART_REPO_INDEX_WITH_NEW_CHARTS)
+
+    updater = Updater(Git(empty_git_repo), HelmRepo(HELM_REPO_URL))
+    updater.update_loop(one_shot=True)
+
+    assert _get_manifest("deploy/2-helmrelease.yaml") == UPDATED_MANIFEST_WITH_FLUX2
+
+
+@pytest.mark.parametrize("batch_commits", [False, True])
+def test_failed_commit_retried(empty_git_repo, requests_mock, batch_commits):
+    mkdir("deploy")
+    paths = ["deploy/1-helmrelease.yaml", "deploy/2-helmrelease.yaml"]
+    for path in paths:
+        _add_manifest(MANIFEST_WITH_FLUX2, path=path)
+    _init_commit()
+    requests_mock.get(HELM_REPO_INDEX, text=CHART_REPO_INDEX_WITH_NEW_CHARTS)
+    git = Git(empty_git_repo)
+    updater = Updater(git, HelmRepo(HELM_REPO_URL), batch_commits=batch_commits)
+    run_git = git._run
+    failures = []
+
+    def fail_first_commit(command, *args, **kwargs):
+        if command[1] in ("commit", "commit-tree") and not failures:
+            failures.append(command)
+            raise UpdateException("Injected commit failure")
+        return run_git(command, *args, **kwargs)
+
+    git._run = fail_first_commit
+    updater.update_loop(one_shot=True)
+    assert failures
+    status = run(
+        ["git", "status", "--porcelain"], cwd=git._git_dir, stdout=PIPE, text=True
+    ).stdout
+    assert status == ""
+    log = run(
+        ["git", "log", "--format=", "--name-only", "master"],
+        stdout=PIPE,
+        text=True,
+        check=True,
+    ).stdout
+    assert log.split() == ([] if batch_commits else [paths[1]]) + paths
+
+    updater.update_loop(one_shot=True)
+    for path in paths:
+        assert _get_manifest(path) == UPDATED_MANIFEST_WITH_FLUX2
+
+
+def test_chart_updated_in_bare_repository(empty_git_repo, requests_mock):
+    _add_manifest(MANIFEST_WITH_FLUX2)
+    _init_commit()
+    requests_mock.get(HELM_REPO_INDEX, text=CHART_REPO_INDEX_WITH_NEW_CHARTS)
+
+    git = Git(empty_git_repo, git_bare=True)
+    updater = Updater(git, HelmRepo(HELM_REPO_URL))
+    updater.update_loop(one_shot=True)
+    git.close()
+
+    assert _get_manifest() == MANIFEST_WITH_FLUX2
+    assert re.search(CHART_RELEASE_COMMIT_RE, _last_commit())
+    assert (
+        run(["git", "show", f"master:{MANIFEST_PATH}"], stdout=PIPE, text=True).stdout
+        == UPDATED_MANIFEST_WITH_FLUX2
+    )
+
+
+@pytest.mark.skipif(Repo is None, reason="needs dulwich")
+@pytest.mark.parametrize("git_bare", [False, True])
+def test_chart_updated_with_dulwich_backend(empty_git_repo, requests_mock, git_bare):
+    _add_manifest(MANIFEST_WITH_FLUX2)
+    _init_commit()
+    requests_mock.get(HELM_REPO_INDEX, text=CHART_REPO_INDEX_WITH_NEW_CHARTS)
+
+    git = DulwichGit(empty_git_repo, git_bare=git_bare)
+    updater = Updater(git, HelmRepo(HELM_REPO_URL))
+    updater.update_loop(one_shot=True)
+    git.close()
+
+    assert re.search(CHART_RELEASE_COMMIT_RE, _last_commit())
+    assert (
+        run(["git", "show", f"master:{MANIFEST_PATH}"], stdout=PIPE, text=True).stdout
+        == UPDATED_MANIFEST_WITH_FLUX2
+    )
+
+
+def test_chart_updated_from_source_ref_repository(empty_git_repo, requests_mock):
+    other_manifest = MANIFEST_WITH_FLUX2.replace(
+        "name: test\n        namespace: flux-system", "name: other"
+    )
+    mkdir("deploy")
+    _add_manifest(MANIFEST_WITH_FLUX2, path="deploy/1-helmrelease.yaml")
+    _add_manifest(other_manifest, path="deploy/2-helmrelease.yaml")
+    _init_commit()
+    requests_mock.get(HELM_REPO_INDEX, text=CHART_REPO_INDEX_WITH_NEW_CHARTS)
+    requests_mock.get(
+        "mock://other.url/index.yaml", text=CHART_REPO_INDEX_WITH_OLD_CHARTS
+    )
+
+    updater = Updater(
+        Git(empty_git_repo),
+        None,
+        helm_repos={
+            "flux-system/test": HelmRepo(HELM_REPO_URL),
+            "other": HelmRepo("mock://other.url"),
+        },
+    )
+    updater.update_loop(one_shot=True)
+
+    assert _get_manifest("deploy/1-helmrelease.yaml") == UPDATED_MANIFEST_WITH_FLUX2
+    assert _get_manifest("deploy/2-helmrelease.yaml") == other_manifest
+    assert requests_mock.call_count == 2
+
+
+def test_only_manifests_of_changed_charts_checked(empty_git_repo, requests_mock):
+    _add_manifest(MANIFEST_WITH_FLUX2)
+    _init_commit()
+    requests_mock.get(HELM_REPO_INDEX, text=CHART_REPO_INDEX_WITH_OLD_CHARTS)
+    updater = Updater(Git(empty_git_repo), HelmRepo(HELM_REPO_URL))
+    updater.update_loop(one_shot=True)
+
+    loaded = _record_loaded_manifests(updater)
+    requests_mock.get(
+        HELM_REPO_INDEX,
+        text=CHART_REPO_INDEX_WITH_OLD_CHARTS
+        + CHART_REPO_INDEX_WITH_ANOTHER_CHART.split("entries:\n")[1],
+    )
+    updater.update_loop(one_shot=True)
+    assert loaded == []
+
+    requests_mock.get(HELM_REPO_INDEX, text=CHART_REPO_INDEX_WITH_NEW_CHARTS)
+    updater.update_loop(one_shot=True)
+    assert loaded == [MANIFEST_PATH]
+    assert _get_manifest() == UPDATED_MANIFEST_WITH_FLUX2
+
+
+def test_nothing_done_when_git_and_index_unchanged(empty_git_repo, requests_mock):
+    mkdir("deploy")
+    _add_manifest(MANIFEST_WITH_FLUX2, path="deploy/1-helmrelease.yaml")
+    _init_commit()
+    requests_mock.get(HELM_REPO_INDEX, text=CHART_REPO_INDEX_WITH_OLD_CHARTS)
+    updater = Updater(Git(empty_git_repo), HelmRepo(HELM_REPO_URL))
+    updater.update_loop(one_shot=True)
+    updater.git.update_branch = Mock(wraps=updater.git.update_branch)
+    loaded = _record_loaded_manifests(updater)
+
+    updater.update_loop(one_shot=True)
+    updater.git.update_branch.assert_not_called()
+
+    requests_mock.get(HELM_REPO_INDEX, text=CHART_REPO_INDEX_WITH_NEW_CHARTS)
+    updater.update_loop(one_shot=True)
+    updater.git.update_branch.assert_not_called()
+    assert loaded == ["deploy/1-helmrelease.yaml"]
+    assert _get_manifest("deploy/1-helmrelease.yaml") == UPDATED_MANIFEST_WITH_FLUX2
+
+    updater.update_loop(one_shot=True)
+    updater.git.update_branch.assert_not_called()
+
+    _add_manifest(MANIFEST_WITH_FLUX2, path="deploy/2-helmrelease.yaml")
+    run(["git", "commit", "-m", "Add manifest"])
+    run(["git", "push", "origin", "master"])
+    updater.update_loop(one_shot=True)
+    updater.git.update_branch.assert_called_once()
+    assert _get_manifest("deploy/2-helmrelease.yaml") == UPDATED_MANIFEST_WITH_FLUX2
+
+
+def test_only_manifests_changed_in_git_checked(empty_git_repo, requests_mock):
+    mkdir("deploy")
+    _add_manifest(MANIFEST_WITH_FLUX2, path="deploy/1-helmrelease.yaml")
+    _init_commit()
+    requests_mock.get(HELM_REPO_INDEX, text=CHART_REPO_INDEX_WITH_NEW_CHARTS)
+    updater = Updater(Git(empty_git_repo), HelmRepo(HELM_REPO_URL))
+    updater.update_loop(one_shot=True)
+    loaded = _record_loaded_manifests(updater)
+
+    _add_manifest(MANIFEST_WITH_FLUX2, path="deploy/2-helmrelease.yaml")
+    run(["git", "commit", "-m", "Add manifest"])
+    run(["git", "push", "origin", "master"])
+    updater.update_loop(one_shot=True)
+    assert loaded == ["deploy/2-helmrelease.yaml"]
+    assert _get_manifest("deploy/2-helmrelease.yaml") == UPDATED_MANIFEST_WITH_FLUX2
+
+    loaded.clear()
+    updater.update_loop(one_shot=True)
+    assert loaded == []
+
+
+def test_unchanged_manifest_not_parsed_again(empty_git_repo, requests_mock):
+    _add_manifest(MANIFEST_WITH_FLUX2)
+    _init_commit()
+    requests_mock.get(HELM_REPO_INDEX, text=CHART_REPO_INDEX_WITH_OLD_CHARTS)
+    updater = Updater(Git(empty_git_repo), HelmRepo(HELM_REPO_URL))
+    updater.update_loop(one_shot=True)
+
+    parsed = []
+    loads = Manifest.loads
+
+    def record_parsed(self, text, round_trip=True, path=""):
+        parsed.append(path)
+        loads(self, text, round_trip, path)
+
+    with patch.object(Manifest, "loads", record_parsed):
+        requests_mock.get(
+            HELM_REPO_INDEX,
+            text=CHART_REPO_INDEX_WITH_OLD_CHARTS.replace("0.0.2", "0.0.3"),
+        )
+        updater.update_loop(one_shot=True)
+        assert parsed == []
+
+        requests_mock.get(HELM_REPO_INDEX, text=CHART_REPO_INDEX_WITH_NEW_CHARTS)
+        updater.update_loop(one_shot=True)
+        assert parsed == [MANIFEST_PATH]
+    assert _get_manifest() == UPDATED_MANIFEST_WITH_FLUX2
+
+
+def test_summaries_of_replaced_manifests_dropped(empty_git_repo, requests_mock):
+    _add_manifest(MANIFEST_WITH_FLUX2)
+    _init_commit()
+    requests_mock.get(HELM_REPO_INDEX, text=CHART_REPO_INDEX_WITH_OLD_CHARTS)
+    updater = Updater(Git(empty_git_repo), HelmRepo(HELM_REPO_URL))
+    updater.update_loop(one_shot=True)
+
+    for revision in range(3):
+        _add_manifest(MANIFEST_WITH_FLUX2 + f"# revision {revision}\n")
+        run(["git", "commit", "-m", "Change manifest"])
+        run(["git", "push", "origin", "master"])
+        updater.update_loop(one_shot=True)
+        assert len(updater._summaries) == 1
+
+
+def test_manifest_without_update_not_round_trip_loaded(empty_git_repo, requests_mock):
+    _add_manifest(MANIFEST_WITH_FLUX2)
+    _init_commit()
+    requests_mock.get(HELM_REPO_INDEX, text=CHART_REPO_INDEX_WITH_OLD_CHARTS)
+
+    with patch("chart_updater.manifest.yaml.round_trip_load") as round_trip_load:
+        updater = Updater(Git(empty_git_repo), HelmRepo(HELM_REPO_URL))
+        updater.update_loop(one_shot=True)
+
+    round_trip_load.assert_not_called()
+    assert _get_manifest() == MANIFEST_WITH_FLUX2
+
+
 def test_chart_no_relevant_annotations(empty_git_repo, requests_mock):
     _add_manifest(MANIFEST_NO_RELEVANT_ANNOTATIONS)
     _init_commit()
@@ -524,6 +865,19 @@ def test_chart_no_relevant_annotations(empty_git_repo, requests_mock):
     assert _get_manifest() == MANIFEST_NO_RELEVANT_ANNOTATIONS
 
 
+def _record_loaded_manifests(updater: Updater) -> List[str]:
+    loaded = []
+    load_manifests = updater._load_manifests
+
+    def record_loaded(paths):
+        paths = list(paths)
+        loaded.extend(paths)
+        return load_manifests(paths)
+
+    updater._load_manifests = record_loaded
+    return loaded
+
+
 def _add_manifest(content: str, path: str = MANIFEST_PATH) -> None:
     with open(path, "w") as f:
         f.write(content)
@@ -0,0 +1,298 @@
+import os
+import tempfile
+from subprocess import PIPE, Popen, run
+
+import pytest
+
+from chart_updater import UpdateException
+from chart_updater.dulwich_git import DulwichGit, Repo
+from chart_updater.git import Git, GitBackend
+
+GIT_BACKENDS = [
+    Git,
+    pytest.param(
+        DulwichGit, marks=pytest.mark.skipif(Repo is None, reason="needs dulwich")
+    ),
+]
+
+HELMRELEASE = """kind: HelmRelease
+metadata:
+  annotations:
+    rossum.ai/chart-auto-update: "true"
+"""
+
+
+@pytest.mark.parametrize("git_class", GIT_BACKENDS)
+def test_backend_interface(git_class):
+    assert isinstance(git_class("url"), GitBackend)
+
+
+@pytest.mark.parametrize("git_class", GIT_BACKENDS)
+def test_grep_single_pass_over_manifests(empty_git_repo, git_class):
+    os.makedirs("deploy/nested")
+    files = {
+        "deploy/b.yaml": HELMRELEASE,
+        "deploy/nested/a.yml": HELMRELEASE,
+        "deploy/notes.txt": HELMRELEASE,
+        "deploy/other.yaml": "kind: HelmRelease\n",
+        "outside.yaml": HELMRELEASE,
+    }
+    for path, content in files.items():
+        with open(path, "w") as f:
+            f.write(content)
+    run(["git", "add", "."])
+
+    git = git_class(empty_git_repo, git_path="deploy")
+
+    assert git.grep(["HelmRelease", "rossum.ai/"]) == [
+        "deploy/b.yaml",
+        "deploy/nested/a.yml",
+    ]
+
+
+@pytest.mark.parametrize("git_class", GIT_BACKENDS)
+def test_changed_files_and_ancestry(empty_git_repo, git_class):
+    os.makedirs("deploy")
+    _commit({"deploy/a.yaml": "a", "deploy/b.yaml": "b", "c.yaml": "c"})
+    git = git_class(empty_git_repo, git_path="deploy")
+    first = git.head()
+
+    run(["git", "mv", "deploy/a.yaml", "deploy/renamed.yaml"])
+    _commit({"deploy/b.yaml": "changed", "deploy/notes.txt": "x", "c.yaml": "x"})
+    second = git.head()
+
+    assert git.changed_files(first, second) == [
+        "deploy/a.yaml",
+        "deploy/b.yaml",
+        "deploy/renamed.yaml",
+    ]
+    assert git.is_ancestor(first, second)
+    assert not git.is_ancestor(second, first)
+
+
+def _write(files):
+    for path, content in files.items():
+        with open(path, "w") as f:
+            f.write(content)
+
+
+def _commit(files):
+    _write(files)
+    run(["git", "add", "."])
+    run(["git", "commit", "-m", "Commit"])
+
+
+@pytest.mark.parametrize("git_class", GIT_BACKENDS)
+def test_blob_ids(empty_git_repo, git_class):
+    _commit({"a.yaml": "a", "b.yaml": "b"})
+    git = git_class(empty_git_repo)
+
+    blob_ids = git.blob_ids(["a.yaml", "missing.yaml"])
+
+    assert list(blob_ids) == ["a.yaml"]
+    assert (
+        blob_ids["a.yaml"]
+        == run(["git", "hash-object", "a.yaml"], stdout=PIPE, text=True).stdout.strip()
+    )
+
+
+@pytest.mark.parametrize("git_class", GIT_BACKENDS)
+def test_commit_files(empty_git_repo, git_class):
+    _commit({"a.yaml": "a", "b.yaml": "b", "c.yaml": "c"})
+    git = git_class(empty_git_repo)
+    parent = git.head()
+    _write({"c.yaml": "not committed"})
+
+    git.commit_files({"a.yaml": "changed", "b.yaml": "changed"}, "Release\n\n- a\n- b")
+
+    commit = git.head()
+    assert git.is_ancestor(parent, commit)
+    assert git.changed_files(parent, commit) == ["a.yaml", "b.yaml"]
+    log = run(["git", "log", "--format=%B", "-1"], stdout=PIPE, text=True).stdout
+    assert log.strip() == "Release\n\n- a\n- b"
+
+
+def test_single_file_committed_in_two_processes(empty_git_repo):
+    _commit({"a.yaml": "a", "b.yaml": "b"})
+    git = Git(empty_git_repo)
+    parent = git.head()
+    _write({"b.yaml": "not committed"})
+    run_git = git._run
+    commands = []
+
+    def record_command(command, *args, **kwargs):
+        commands.append(command[1])
+        return run_git(command, *args, **kwargs)
+
+    git._run = record_command
+    git.commit_files({"a.yaml": "changed"}, "Release of a")
+
+    assert commands == ["add", "commit"]
+    assert git.changed_files(parent, git.head()) == ["a.yaml"]
+
+
+@pytest.mark.parametrize("git_bare", [False, True])
+@pytest.mark.parametrize("git_class", GIT_BACKENDS)
+def test_undecodable_file_left_out(empty_git_repo, git_class, git_bare):
+    with open("latin1.yaml", "wb") as f:
+        f.write(HELMRELEASE.encode() + "# caf\xe9\n".encode("latin-1"))
+    _commit({"a.yaml": "a"})
+    git = git_class(empty_git_repo, git_bare=git_bare)
+    git.clone_repo()
+
+    assert git.read_files(["a.yaml", "latin1.yaml"]) == {"a.yaml": "a"}
+    git.close()
+
+
+@pytest.mark.parametrize("git_class", GIT_BACKENDS)
+def test_blobless_bare_repository(empty_git_repo, git_class):
+    _commit({"a.yaml": HELMRELEASE, "b.yaml": "b"})
+    run(["git", "config", "uploadpack.allowFilter", "true"])
+    git = git_class(f"file://{empty_git_repo}", git_bare=True, git_blobless=True)
+    git.clone_repo()
+
+    assert git.grep(["HelmRelease", "rossum.ai/"]) == ["a.yaml"]
+    assert git.read_files(["b.yaml"]) == {"b.yaml": "b"}
+    git.close()
+
+
+def test_blob_reader_restarted_after_failure(empty_git_repo):
+    _commit({"a.yaml": "a"})
+    git = Git(empty_git_repo, git_bare=True, git_timeout=1)
+    git.clone_repo()
+    assert git.read_files(["a.yaml"]) == {"a.yaml": "a"}
+
+    git._cat_file.kill()
+    git._cat_file.wait()
+    with pytest.raises(UpdateException):
+        git.read_files(["a.yaml"])
+    assert git.read_files(["a.yaml"]) == {"a.yaml": "a"}
+
+    git.close()
+    git._cat_file = Popen(["sleep", "10"], stdin=PIPE, stdout=PIPE, bufsize=0)
+    with pytest.raises(UpdateException, match="did not answer"):
+        git.read_files(["a.yaml"])
+    assert git.read_files(["a.yaml"]) == {"a.yaml": "a"}
+    git.close()
+
+
+def test_shallow_sparse_clone_and_branch_update(empty_git_repo):
+    os.makedirs("deploy")
+    os.makedirs("other")
+    _commit({"deploy/a.yaml": "a", "other/b.yaml": "b"})
+    _commit({"deploy/a.yaml": "a2"})
+    run(["git", "branch", "unrelated"])
+    run(["git", "config", "uploadpack.allowFilter", "true"])
+    origin = f"file://{empty_git_repo}"
+    git = Git(
+        origin, git_path="deploy", git_depth=1, git_blobless=True, git_sparse=True
+    )
+
+    git.clone_repo()
+
+    assert os.path.exists("deploy/a.yaml")
+    assert not os.path.exists("other")
+    assert _git_output(["rev-list", "--count", "HEAD"]) == "1"
+
+    os.chdir(empty_git_repo)
+    _commit({"deploy/a.yaml": "a3"})
+    os.chdir(git._git_dir)
+    git.update_branch()
+
+    with open("deploy/a.yaml") as f:
+        assert f.read() == "a3"
+    assert _git_output(["rev-list", "--count", "HEAD"]) == "2"
+    assert "unrelated" not in _git_output(["branch", "-r"])
+
+
+def _git_output(args):
+    return run(["git", *args], stdout=PIPE, text=True).stdout.strip()
+
+
+def test_workdir_reused_when_valid(empty_git_repo):
+    _commit({"a.yaml": "a"})
+    workdir = os.path.join(tempfile.mkdtemp(), "checkout")
+    Git(empty_git_repo, git_workdir=workdir).clone_repo()
+    with open(".git/marker", "w") as f:
+        f.write("reused")
+
+    Git(empty_git_repo, git_workdir=workdir).clone_repo()
+    assert os.getcwd() == workdir
+    assert os.path.exists(".git/marker")
+
+    with open("a.yaml", "w") as f:
+        f.write("local change")
+    Git(empty_git_repo, git_workdir=workdir).clone_repo()
+    assert not os.path.exists(".git/marker")
+    with open("a.yaml") as f:
+        assert f.read() == "a"
+
+
+def test_reused_workdir_follows_clone_settings(empty_git_repo):
+    os.makedirs("deploy")
+    os.makedirs("other")
+    _commit({"deploy/a.yaml": "a", "other/b.yaml": "b"})
+    _commit({"deploy/a.yaml": "a2"})
+    run(["git", "config", "uploadpack.allowFilter", "true"])
+    origin = f"file://{empty_git_repo}"
+    workdir = os.path.join(tempfile.mkdtemp(), "checkout")
+    Git(origin, git_path="deploy", git_sparse=True, git_workdir=workdir).clone_repo()
+    assert not os.path.exists("other")
+    with open(".git/marker", "w") as f:
+        f.write("reused")
+
+    Git(origin, git_path="deploy", git_workdir=workdir).clone_repo()
+    assert os.path.exists(".git/marker")
+    assert os.path.exists("other/b.yaml")
+
+    Git(origin, git_path="other", git_sparse=True, git_workdir=workdir).clone_repo()
+    assert os.path.exists(".git/marker")
+    assert not os.path.exists("deploy")
+
+    Git(origin, git_depth=1, git_workdir=workdir).clone_repo()
+    assert not os.path.exists(".git/marker")
+    assert _git_output(["rev-list", "--count", "HEAD"]) == "1"
+    assert os.path.exists("deploy/a.yaml")
+    with open(".git/marker", "w") as f:
+        f.write("reused")
+
+    Git(origin, git_depth=1, git_blobless=True, git_workdir=workdir).clone_repo()
+    assert not os.path.exists(".git/marker")
+    assert _git_output(["config", "remote.origin.partialclonefilter"]) == "blob:none"
+
+
+def test_workdir_not_cleared_when_not_git_checkout(empty_git_repo):
+    _commit({"a.yaml": "a"})
+    workdir = tempfile.mkdtemp()
+    _write({os.path.join(workdir, "data.txt"): "data"})
+
+    with pytest.raises(UpdateException):
+        Git(empty_git_repo, git_workdir=workdir).clone_repo()
+    assert os.path.exists(os.path.join(workdir, "data.txt"))
+
+
+@pytest.mark.parametrize("git_class", GIT_BACKENDS)
+def test_bare_repository(empty_git_repo, git_class):
+    os.makedirs("deploy")
+    _commit({"deploy/a.yaml": HELMRELEASE, "deploy/b.yaml": "b", "c.yaml": "c"})
+    run(["git", "checkout", "-b", "test"])
+    git = git_class(empty_git_repo, git_path="deploy", git_bare=True)
+
+    git.clone_repo()
+
+    assert os.getcwd() == empty_git_repo
+    assert not os.path.exists(os.path.join(git._git_dir, "deploy"))
+    assert git.grep(["HelmRelease", "rossum.ai/"]) == ["deploy/a.yaml"]
+    assert git.read_files(["deploy/b.yaml", "missing.yaml"]) == {"deploy/b.yaml": "b"}
+
+    parent = git.head()
+    git.commit_files({"deploy/b.yaml": "changed"}, "Update")
+    assert git.changed_files(parent, git.head()) == ["deploy/b.yaml"]
+    assert git.read_files(["deploy/b.yaml", "c.yaml"]) == {
+        "deploy/b.yaml": "changed",
+        "c.yaml": "c",
+    }
+
+    git.update_branch()
+    assert git.head() == parent
+    git.close()
@@ -0,0 +1,445 @@
+import gzip
+import hashlib
+import json
+import pickle
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import yaml
+
+from chart_updater import UpdateException
+from chart_updater.helm_repo import (
+    ChartMuseumRepo,
+    ChartVersion,
+    HelmRepo,
+    select_index_entries,
+)
+
+HELM_REPO_URL = "mock://some.url"
+HELM_REPO_INDEX = f"{HELM_REPO_URL}/index.yaml"
+
+CHART_REPO_INDEX = """
+apiVersion: v1
+entries:
+  hello-world:
+  - version: 1.2.3
+    created: "2020-01-02T13:57:16.097Z"
+    appVersion: v10.11.12
+  - version: 1.2.4
+    created: "2020-01-03T13:57:16.097Z"
+    appVersion: v10.11.15
+"""
+
+UNSORTED_CHART_REPO_INDEX = """
+apiVersion: v1
+entries:
+  hello-world:
+  - version: 1.2.9
+    created: "2020-01-02T13:57:16.097123456+01:00"
+    appVersion: v1
+  - version: 1.3.0
+    created: 2020-01-04T13:57:16Z
+    appVersion: v3
+  - version: 1.2.10
+    created: "2020-01-02T13:57:16.097123456+01:00"
+    appVersion: v2
+  - version: 1.1.0
+    created: "2020-01-01T13:57:16.097Z"
+    appVersion: v0
+"""
+
+SHARED_CHART_REPO_INDEX = """apiVersion: v1
+entries:
+  cert-manager:
+  - version: 0.11.0
+    created: "2019-10-10T13:57:16.097Z"
+    description: |
+      Certificates
+
+      for everyone
+  "hello-world":
+  - version: 1.2.4
+    created: "2020-01-03T13:57:16.097Z"
+    appVersion: v10.11.15
+  other: []
+generated: "2020-01-03T13:57:16.097Z"
+"""
+
+
+@pytest.fixture
+def chartmuseum():
+    charts = {"hello-world": yaml.safe_load(CHART_REPO_INDEX)["entries"]["hello-world"]}
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            received.append((self.path, self.headers.get("If-None-Match")))
+            chart_name = self.path[len("/api/charts/") :]
+            if not self.path.startswith("/api/charts/") or chart_name not in charts:
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = json.dumps(charts[chart_name]).encode()
+            etag = f'"{hashlib.sha256(body).hexdigest()}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    with _serve(Handler) as url:
+        yield url, charts, received
+
+
+@contextmanager
+def _serve(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _index_handler(delay: float = 0, status: int = 200):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(delay)
+            body = CHART_REPO_INDEX.encode()
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def test_index_not_modified(requests_mock):
+    requests_mock.get(
+        HELM_REPO_INDEX,
+        [
+            {"text": CHART_REPO_INDEX, "headers": {"ETag": '"abc"'}},
+            {"status_code": 304},
+        ],
+    )
+    helm_repo = HelmRepo(HELM_REPO_URL)
+    helm_repo.update()
+    helm_repo.update()
+
+    assert requests_mock.call_count == 2
+    assert "If-None-Match" not in requests_mock.request_history[0].headers
+    assert requests_mock.request_history[1].headers["If-None-Match"] == '"abc"'
+    assert helm_repo.get_latest_chart_versions("hello-world", "glob:1.2.*") == (
+        "1.2.4",
+        "v10.11.15",
+    )
+
+
+def test_index_downloaded_again_after_parse_failure(requests_mock):
+    requests_mock.get(
+        HELM_REPO_INDEX,
+        [
+            {"text": CHART_REPO_INDEX, "headers": {"ETag": '"abc"'}},
+            {"text": "entries: [", "headers": {"ETag": '"broken"'}},
+            {"text": CHART_REPO_INDEX.replace("1.2.4", "1.2.5")},
+        ],
+    )
+    helm_repo = HelmRepo(HELM_REPO_URL)
+    helm_repo.update()
+    with pytest.raises(UpdateException):
+        helm_repo.update()
+    helm_repo.update()
+
+    assert requests_mock.request_history[2].headers["If-None-Match"] == '"abc"'
+    assert helm_repo.get_latest_chart_versions("hello-world", "glob:1.2.*")[0] == (
+        "1.2.5"
+    )
+
+
+def test_index_unchanged_content_not_parsed(requests_mock, monkeypatch):
+    requests_mock.get(HELM_REPO_INDEX, text=CHART_REPO_INDEX)
+    helm_repo = HelmRepo(HELM_REPO_URL)
+    helm_repo.update()
+    catalog = helm_repo._catalog
+
+    def fail(*args, **kwargs):
+        raise AssertionError("index parsed again")
+
+    monkeypatch.setattr(helm_repo, "_parse_index", fail)
+    helm_repo.update()
+
+    assert helm_repo._catalog is catalog
+
+
+def test_index_requested_with_timeout_and_auth(requests_mock):
+    requests_mock.get(HELM_REPO_INDEX, text=CHART_REPO_INDEX)
+    helm_repo = HelmRepo(
+        HELM_REPO_URL, "user", "secret", connect_timeout=1, read_timeout=2
+    )
+    helm_repo.update()
+    helm_repo.update()
+
+    request = requests_mock.last_request
+    assert request.timeout == (1, 2)
+    assert request.headers["Authorization"].startswith("Basic ")
+    assert helm_repo._session.get_adapter("https://").max_retries.total == 3
+
+
+def test_latest_chart_by_creation_time(requests_mock):
+    requests_mock.get(HELM_REPO_INDEX, text=UNSORTED_CHART_REPO_INDEX)
+    helm_repo = HelmRepo(HELM_REPO_URL)
+    helm_repo.update()
+
+    assert helm_repo.get_latest_chart_versions("hello-world", "glob:1.*") == (
+        "1.3.0",
+        "v3",
+    )
+    assert helm_repo.get_latest_chart_versions("hello-world", "semver:1.2.x") == (
+        "1.2.10",
+        "v2",
+    )
+    assert helm_repo.get_latest_chart_versions("hello-world", "glob:2.*") == (
+        None,
+        None,
+    )
+
+
+def test_latest_chart_versions_memoized(requests_mock, monkeypatch):
+    requests_mock.get(HELM_REPO_INDEX, text=CHART_REPO_INDEX)
+    helm_repo = HelmRepo(HELM_REPO_URL)
+    helm_repo.update()
+    assert helm_repo.get_latest_chart_versions("hello-world", "semver:1.2.x") == (
+        "1.2.4",
+        "v10.11.15",
+    )
+
+    monkeypatch.setattr(helm_repo, "_get_latest_chart", None)
+    assert helm_repo.get_latest_chart_versions("hello-world", "semver:1.2.x") == (
+        "1.2.4",
+        "v10.11.15",
+    )
+
+
+def test_json_index(requests_mock):
+    index_json = json.dumps(yaml.safe_load(CHART_REPO_INDEX))
+    requests_mock.get(
+        HELM_REPO_INDEX,
+        text=index_json,
+        headers={"Content-Type": "application/json"},
+    )
+    requests_mock.get(f"{HELM_REPO_URL}/index.json", text=index_json)
+
+    for helm_repo in [
+        HelmRepo(HELM_REPO_URL),
+        HelmRepo(HELM_REPO_URL, index_path="index.json"),
+    ]:
+        helm_repo.update()
+        assert helm_repo.get_latest_chart_versions("hello-world", "glob:1.2.*") == (
+            "1.2.4",
+            "v10.11.15",
+        )
+    assert "application/json" in requests_mock.last_request.headers["Accept"]
+
+
+def test_select_index_entries():
+    selected = select_index_entries(
+        SHARED_CHART_REPO_INDEX.encode().splitlines(keepends=True),
+        {"hello-world", "missing"},
+    )
+    assert yaml.safe_load(selected) == {
+        "entries": {
+            "hello-world": [
+                {
+                    "version": "1.2.4",
+                    "created": "2020-01-03T13:57:16.097Z",
+                    "appVersion": "v10.11.15",
+                }
+            ]
+        }
+    }
+    assert select_index_entries([b'{"entries": {}}'], {"hello-world"}) is None
+
+
+def test_selective_index_parsing(requests_mock):
+    requests_mock.get(
+        HELM_REPO_INDEX, text=SHARED_CHART_REPO_INDEX, headers={"ETag": '"abc"'}
+    )
+    helm_repo = HelmRepo(HELM_REPO_URL, selective=True)
+    helm_repo.update({"hello-world"})
+    assert set(helm_repo._catalog) == {"hello-world"}
+
+    helm_repo.update({"hello-world"})
+    assert requests_mock.last_request.headers["If-None-Match"] == '"abc"'
+
+    helm_repo.update({"hello-world", "cert-manager"})
+    assert "If-None-Match" not in requests_mock.last_request.headers
+    assert set(helm_repo._catalog) == {"hello-world", "cert-manager"}
+    assert helm_repo.get_latest_chart_versions("cert-manager", "glob:*") == (
+        "0.11.0",
+        None,
+    )
+
+
+def test_index_cache_reused_after_restart(requests_mock, tmp_path):
+    requests_mock.get(
+        HELM_REPO_INDEX,
+        [
+            {"text": CHART_REPO_INDEX, "headers": {"ETag": '"abc"'}},
+            {"status_code": 304},
+        ],
+    )
+    HelmRepo(HELM_REPO_URL, cache_dir=str(tmp_path)).update()
+
+    helm_repo = HelmRepo(HELM_REPO_URL, cache_dir=str(tmp_path))
+    assert helm_repo.get_latest_chart_versions("hello-world", "glob:1.2.*") == (
+        "1.2.4",
+        "v10.11.15",
+    )
+    helm_repo.update()
+    assert requests_mock.last_request.headers["If-None-Match"] == '"abc"'
+    assert helm_repo.get_latest_chart_versions("hello-world", "glob:1.2.*") == (
+        "1.2.4",
+        "v10.11.15",
+    )
+
+
+def test_catalog_keeps_compact_chart_versions(requests_mock):
+    requests_mock.get(HELM_REPO_INDEX, text=SHARED_CHART_REPO_INDEX)
+    helm_repo = HelmRepo(HELM_REPO_URL)
+    helm_repo.update()
+
+    (chart,) = helm_repo._catalog["cert-manager"]
+    assert isinstance(chart, ChartVersion)
+    assert not hasattr(chart, "__dict__")
+    assert (chart.version, chart.app_version) == ("0.11.0", None)
+
+    restored = pickle.loads(pickle.dumps(chart))
+    assert (restored.version, restored.created, restored.semver) == (
+        chart.version,
+        chart.created,
+        chart.semver,
+    )
+
+
+def test_gzipped_index_streamed(requests_mock, caplog):
+    content = CHART_REPO_INDEX.encode() * 50
+    requests_mock.get(
+        HELM_REPO_INDEX,
+        content=gzip.compress(content),
+        headers={"Content-Encoding": "gzip"},
+    )
+    helm_repo = HelmRepo(HELM_REPO_URL)
+    helm_repo.update()
+
+    assert "gzip" in requests_mock.last_request.headers["Accept-Encoding"]
+    assert helm_repo.get_latest_chart_versions("hello-world", "glob:1.2.*") == (
+        "1.2.4",
+        "v10.11.15",
+    )
+    assert f"{len(gzip.compress(content))} bytes transferred" in caplog.text
+    assert f"{len(content)} bytes decoded" in caplog.text
+
+
+def test_chartmuseum_per_chart_lookups(chartmuseum):
+    url, charts, received = chartmuseum
+    helm_repo = ChartMuseumRepo(url)
+    helm_repo.update(["hello-world", "missing"])
+
+    assert sorted(received) == [
+        ("/api/charts/hello-world", None),
+        ("/api/charts/missing", None),
+    ]
+    assert helm_repo.get_latest_chart_versions("hello-world", "glob:1.2.*") == (
+        "1.2.4",
+        "v10.11.15",
+    )
+    assert helm_repo.get_latest_chart_versions("missing", "glob:*") == (None, None)
+
+    received.clear()
+    charts["hello-world"].append(
+        {"version": "1.2.5", "created": "2020-01-04T13:57:16.097Z", "appVersion": "v5"}
+    )
+    helm_repo.update(["hello-world"])
+
+    ((path, etag),) = received
+    assert path == "/api/charts/hello-world"
+    assert etag is not None
+    assert helm_repo.get_latest_chart_versions("hello-world", "glob:1.2.*") == (
+        "1.2.5",
+        "v5",
+    )
+
+    received.clear()
+    catalog = helm_repo._catalog
+    helm_repo.update(["hello-world"])
+    assert len(received) == 1
+    assert helm_repo._catalog is catalog
+
+
+def test_hedged_request_to_faster_mirror():
+    with _serve(_index_handler(delay=1)) as slow, _serve(_index_handler()) as fast:
+        helm_repo = HelmRepo(slow, mirror_urls=[fast], hedge_delay=0.05)
+        start = time.monotonic()
+        helm_repo.update()
+
+        assert time.monotonic() - start < 0.9
+        assert helm_repo._index_source == fast
+        assert helm_repo._mirrors_by_latency() == [fast, slow]
+        assert helm_repo.get_latest_chart_versions("hello-world", "glob:1.2.*") == (
+            "1.2.4",
+            "v10.11.15",
+        )
+
+
+def test_failed_mirror_skipped():
+    with _serve(_index_handler(status=404)) as broken, _serve(
+        _index_handler()
+    ) as working:
+        helm_repo = HelmRepo(broken, mirror_urls=[working], hedge_delay=10)
+        helm_repo.update()
+
+        assert helm_repo._index_source == working
+        assert helm_repo._mirrors_by_latency() == [working, broken]
+
+
+def test_unmeasured_mirror_tried_after_measured_ones():
+    helm_repo = HelmRepo("mock://primary", mirror_urls=["mock://a", "mock://b"])
+    helm_repo._record_latency("mock://b", 0.5)
+
+    assert helm_repo._mirrors_by_latency() == [
+        "mock://b",
+        "mock://primary",
+        "mock://a",
+    ]
+
+
+def test_update_returns_changed_charts(requests_mock):
+    requests_mock.get(
+        HELM_REPO_INDEX,
+        [
+            {"text": SHARED_CHART_REPO_INDEX, "headers": {"ETag": '"abc"'}},
+            {"status_code": 304},
+            {"text": SHARED_CHART_REPO_INDEX.replace("1.2.4", "1.2.5")},
+        ],
+    )
+    helm_repo = HelmRepo(HELM_REPO_URL)
+
+    assert helm_repo.update() is None
+    assert helm_repo.update() == set()
+    assert helm_repo.update() == {"hello-world"}
@@ -0,0 +1,44 @@
+import yaml
+
+from chart_updater.manifest import patch_scalars
+
+MANIFEST = """\
+# keep this comment
+spec:
+  chart:
+    spec:
+      version: '1.0.0'   # pinned
+  values:
+    image:
+      tag: "1.0.0"
+    worker:
+      image: {repository: worker, tag: 1.0.0}
+"""
+
+
+def test_patch_keeps_quotes_and_comments():
+    text = patch_scalars(
+        MANIFEST,
+        {
+            ("spec", "chart", "spec", "version"): "1.2.0",
+            ("spec", "values", "image", "tag"): "1.2.0",
+            ("spec", "values", "worker", "image", "tag"): "1.10.0",
+        },
+    )
+
+    assert text == MANIFEST.replace("'1.0.0'", "'1.2.0'").replace(
+        '"1.0.0"', '"1.2.0"'
+    ).replace("tag: 1.0.0}", "tag: 1.10.0}")
+
+
+def test_patch_quotes_plain_scalar_when_needed():
+    text = patch_scalars(MANIFEST, {("spec", "values", "worker", "image", "tag"): "1"})
+
+    assert 'tag: "1"}' in text
+    assert yaml.safe_load(text)["spec"]["values"]["worker"]["image"]["tag"] == "1"
+
+
+def test_patch_refuses_missing_and_block_scalars():
+    assert patch_scalars(MANIFEST, {("spec", "values", "other", "tag"): "1"}) is None
+    block = MANIFEST.replace('tag: "1.0.0"', "tag: |\n        1.0.0")
+    assert patch_scalars(block, {("spec", "values", "image", "tag"): "1.2.0"}) is None
@@ -0,0 +1,31 @@
+import pytest
+
+from chart_updater import UpdateException
+from chart_updater.version_pattern import VersionPattern, compile_version_pattern
+
+
+@pytest.mark.parametrize(
+    "pattern,version,expected",
+    [
+        ("glob:1.2.*", "1.2.4", True),
+        ("glob:1.2.*", "1.3.0", False),
+        ("regex:^1\\.2\\.", "1.2.4", True),
+        ("regexp:^1\\.2\\.", "11.2.4", False),
+        ("regex:^1:2", "1:2", True),
+        ("semver:1.2.x", "1.2.4", True),
+        ("semver:1.2.x", "1.3.0", False),
+        ("semver:1.2.x", "not-a-version", False),
+    ],
+)
+def test_pattern_match(pattern, version, expected):
+    assert VersionPattern(pattern).match(version) == expected
+
+
+@pytest.mark.parametrize("pattern", ["1.2.*", "foo:1.2.*", "regex:(", "semver:!!"])
+def test_invalid_pattern(pattern):
+    with pytest.raises(UpdateException):
+        VersionPattern(pattern)
+
+
+def test_compiled_pattern_cached():
+    assert compile_version_pattern("glob:1.*") is compile_version_pattern("glob:1.*")